@@ -26,24 +26,36 @@ Local_storage_folder
 [...]
 
 -> GTV.txt contains the name of the GTV(s) in the DICOM
+-> path_origin can also be a .zip or .tar(.gz) archive with this layout (optionally inside a top-level folder)
 """
 
 import nibabel as nib
 import numpy as np
 import os
-import glob
+import hashlib
+import json
 import pydicom
-import pickle
 import random
 import shutil
+import tempfile
+import time
+import collections
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from tqdm import tqdm
-from rt_utils import RTStructBuilder
+from nifti_writer import save_nifti, file_ending
+from Nifti_cropping import crop_images, bbox_mode, merge_overlapping_bboxes, target_spacing, label_resampling
+from instrumentation import StageLog, RunReport, stage, file_bytes
+from slice_metadata import SliceMetadataStore, METADATA_NAME
+from fingerprint import case_fingerprint, file_fingerprint, write_fingerprint
+from dicom_sources import open_source, prefetch
 
 # Set dataset name (used for directory creation under nnUNet_raw)
 Dataset_id = 801 # <-- CHANGE THIS as needed (should be unique. Ideally, choose value above 500 to avoid name-conflicts with existing nnUnet datasets)
 Dataset_name = "SBRTest" # <-- CHANGE THIS as needed
 
-# Root folder where DICOM files are located (patients in subfolders)
+# Root folder where DICOM files are located (patients in subfolders), or a .zip / .tar(.gz) archive of that folder
 path_origin = "I:\\PHYSICS\\Ben\\DICOM\\"  # <-- CHANGE THIS as needed
 
 # Set to False if ROIs are the same across all phases. Set to None if the algorithm is to auto-detect (assuming a particular format)
@@ -52,6 +64,35 @@ use_phase_specific_gtv_names = None  # <-- CHANGE THIS as needed. None, True, Fa
 # Test/train split ratio for dataset preparation. Training will be used in a 5-fold CV scheme. E.g. 20% test / 80% train
 Test_split = 0.40  # <-- CHANGE THIS as needed
 
+# Number of worker processes converting (patient, phase) units in parallel. 1 = no process pool
+n_workers = 1  # <-- CHANGE THIS as needed
+# With n_workers = 1: phases read ahead / written behind the current one by threads. 0 = one phase at a time
+pipeline_depth = 2  # <-- CHANGE THIS as needed (memory grows with it)
+
+# NIfTI output: "gzip" (standard .nii.gz), "pgzip" (multi-threaded .nii.gz) or "nii" (uncompressed, for scratch datasets)
+output_mode = "gzip"  # <-- CHANGE THIS as needed
+compression_level = 1  # <-- CHANGE THIS as needed (gzip level, 1: fastest ... 9: smallest)
+
+# Crop around the GTVs while converting and write DatasetXXX_<name>CROPPED directly (crop settings in Nifti_cropping.py)
+crop_during_conversion = False  # <-- CHANGE THIS as needed
+write_uncropped = True  # <-- CHANGE THIS to False to only write the CROPPED dataset (with crop_during_conversion = True)
+
+# Phases of a patient with the same slices (4D CT) reuse the geometry and slice selection of its first phase
+share_patient_geometry = True  # <-- CHANGE THIS to False to handle every phase on its own
+# Also write all the phases of each patient as one 4D image / label volume (images4DTr, labels4DTr...)
+write_4d = False  # <-- CHANGE THIS as needed
+
+# RAM budget (MB) for the image + mask volumes of one phase. Larger series are assembled in disk-backed memory maps
+# (temporary files in scratch_dir, None = system temp folder) and written slice by slice. None = always in RAM
+memory_budget_mb = None  # <-- CHANGE THIS as needed, e.g. 2000
+scratch_dir = None  # <-- CHANGE THIS as needed
+
+# Also write the slice metadata of each case as sliceLOCTr / sliceLOCTs pickles (it is always in slice_metadata.sqlite)
+export_slice_pickles = False  # <-- CHANGE THIS to True for tools reading the pickles
+
+# Per-stage timing / memory report of the run (JSON lines, see instrumentation.py). None = no instrumentation
+report_path = None  # <-- CHANGE THIS as needed, e.g. "conversion_report.jsonl"
+
 
 
 
@@ -64,12 +105,42 @@ path_target = os.environ['nnUNet_raw'] + "/" + full_dataset_name + "/"
 # ===========================
 # Main Conversion Function
 # ===========================
-def main(path_origin, path_target, delete_origin_data=False, overwrite_converted_data=True):
+def main(path_origin, path_target, delete_origin_data=False, overwrite_converted_data=True, workers=1, hash_inputs=False,
+         output_mode="gzip", compression_level=1, crop=False, write_uncropped=True, bbox_options=None, report_path=None,
+         export_pickles=False, pipeline_depth=2, share_geometry=True, write_4d=False, memory_budget_mb=None, scratch_dir=None):
     """Converts DICOM + RTStruct data into nnUNet-style NIfTI images and segmentation masks.
     Saves CTs in 'imagesTr' / 'imagesTest', masks in 'labelsTr' / 'labelsTest'.
 
-    -> delete_origin_data can be set to True if you want to delete each DICOM files as they are processed. 
+    -> path_origin can also be a .zip or .tar(.gz) archive of the patient folders, read without extracting it
+       (see dicom_sources.py).
+    -> delete_origin_data can be set to True if you want to delete each DICOM files as they are processed (not
+       for archives).
     -> overwrite_converted_data can be set to True if you want to have a fresh dataset for nnUnet.
+    -> workers > 1 converts the (patient, phase) units in a pool of that many processes. With workers = 1 and
+       pipeline_depth > 0, reading, conversion and writing of consecutive units overlap in threads of this process
+       (see run_pipelined), with at most pipeline_depth phases waiting to be converted or written.
+    -> hash_inputs can be set to True to also hash the DICOM contents when checking for changed inputs (slower).
+    -> output_mode / compression_level select how NIfTI files are written (see nifti_writer.OUTPUT_MODES).
+    -> crop can be set to True to crop the in-memory volumes around the GTVs (Nifti_cropping.crop_images, with
+       bbox_options, which can also resample the crops to a target spacing) and write them to path_target + "CROPPED", without the reload of a separate cropping run.
+       write_uncropped can then be set to False to skip the full-size volumes (slice location pickles are kept).
+    -> export_pickles can be set to True to also write the slice metadata as sliceLOC pickles.
+    -> share_geometry = True reads the slice geometry of a patient once: phases with the same slices as its first
+       converted phase reuse its slice selection and affine (import_US_stack_shared), the others are converted on their own.
+    -> write_4d can be set to True to also write the phases of each patient as one 4D volume (see Volumes4D) to
+       images4DTr / labels4DTr (images4DTs / labels4DTs). A patient with a changed phase is then converted again as a whole.
+    -> memory_budget_mb can be set to the RAM (in MB) the image and mask of one phase may use: larger volumes are
+       assembled in np.memmap files of scratch_dir (see new_volume) and streamed slice by slice to the NIfTI writer.
+       Cropping (crop) and 4D volumes (write_4d) still load the volumes they use.
+    -> report_path can be set to a .jsonl file to record the time, bytes and memory of each stage of each
+       (patient, phase), followed by a summary (see instrumentation.RunReport).
+
+    A manifest (conversion_manifest.json) in path_target records, for each patient and phase, the fingerprint
+    of its inputs, its outputs and its train/test split. Only new or changed phases are converted on re-runs.
+    The slice metadata of each case (slice locations, ImagePositionPatient, PixelSpacing) goes to the dataset's
+    slice_metadata.sqlite (see slice_metadata.py), with the crop bounding boxes in the cropped dataset.
+    Foreground intensity, shape and spacing statistics of the training cases are collected during the conversion
+    and written to fingerprint_stats.json (see fingerprint.py).
     """
 
     if os.path.exists(path_target):
@@ -81,6 +152,8 @@ def main(path_origin, path_target, delete_origin_data=False, overwrite_converted
                     print(f"> Creating a fresh nnUnet_raw directory for {full_dataset_name}")
                     shutil.rmtree(path_target)
                     os.makedirs(path_target)
+                    if crop and os.path.exists(path_target.rstrip("/") + "CROPPED/"):
+                        shutil.rmtree(path_target.rstrip("/") + "CROPPED/")
                     break
                 elif cont == "n":
                     break
@@ -90,65 +163,42 @@ def main(path_origin, path_target, delete_origin_data=False, overwrite_converted
 
     path_images = path_target + "imagesTr/"
     path_labels = path_target + "labelsTr/"
-    path_LOC = path_target + "sliceLOCTr/"
-    # originally imageTest, labelsTest, and sliceLOCTest. Changed to follow nnUnet documentation
+    # originally imageTest and labelsTest. Changed to follow nnUnet documentation
     path_images_T = path_target + "imagesTs/" 
     path_labels_T = path_target + "labelsTs/"
-    path_LOC_T = path_target + "sliceLOCTs/"
     
-    for P in [path_images,path_labels,path_LOC,path_images_T,path_labels_T,path_LOC_T]:
+    for P in [path_images,path_labels,path_images_T,path_labels_T]:
         if not os.path.exists(P):
             os.makedirs(P)
+
+    # Cropped dataset, same layout
+    path_crop = path_target.rstrip("/") + "CROPPED/" if crop else None
+    if crop:
+        for P in ["imagesTr", "labelsTr", "imagesTs", "labelsTs"]:
+            os.makedirs(path_crop + P, exist_ok=True)
+    store = SliceMetadataStore(path_target + METADATA_NAME)
+    crop_store = SliceMetadataStore(path_crop + METADATA_NAME) if crop else None
         
-    # Identify patient folders (e.g., PatID1, PatID2...)
-    folder_list = glob.glob(path_origin + "*/")
-    ID_list_Origin = [Pa for Pa in os.listdir(path_origin) if os.path.isdir(path_origin+Pa)]
+    # Identify patient folders (e.g., PatID1, PatID2...), from the directory or the archive index
+    source = open_source(path_origin)
+    ID_list_Origin = source.patients()
 
     # Safety check: warn if no valid folders are found
     if len(ID_list_Origin) == 0: 
-        print(f"WARNING: No files found in directory: {path_origin+os.listdir(path_origin)[0]}. Check slashes or folder structure.")
-            
-    # Remove already processed IDs from training/test list (avoids duplicates)
-    TEMP = glob.glob(path_images + "*.nii.gz")
-    ID_list_Target_Tr = [os.path.basename(P).split("_")[0] for P in TEMP]
-    # ID_list_Target_Tr = []
-    # for P in TEMP:
-    #     P1 = os.path.basename(P)
-    #     P1_splits = P1.split("_")
-    #     if P1_splits[0] not in ID_list_Target_Tr:
-    #         ID_list_Target_Tr.append(P1_splits[0])
-            
-    TEMP = glob.glob(path_images_T + "*.nii.gz")
-    ID_list_Target_Ts = [os.path.basename(P).split("_") for P in TEMP]
-    # ID_list_Target_Test = []
-    # for P in TEMP:
-    #     P1 = os.path.basename(P)
-    #     P1_splits = P1.split("_")
-    #     if P1_splits[0] not in ID_list_Target_Test:
-    #         ID_list_Target_Test.append(P1_splits[0])
-    
-    # Filter out already-processed patients from the origin list
-    ID_list_Origin = [ID for ID in ID_list_Origin if ID not in ID_list_Target_Tr and ID not in ID_list_Target_Ts]
+        print(f"WARNING: No patient folders found in: {path_origin}. Check slashes or folder structure.")
+    if delete_origin_data and not source.deletable:
+        print(f"WARNING: {path_origin} is an archive, delete_origin_data is ignored.")
+        delete_origin_data = False
 
-    # Determine how many total cases and how to split them
-    total_n_im = len(ID_list_Origin) + len(ID_list_Target_Tr) + len(ID_list_Target_Ts)            
-    n_test = int(np.round(total_n_im*(Test_split)))
-    n_train = total_n_im - n_test
-    n_test_missing = n_test - len(ID_list_Target_Ts)
-    
-    # Randomly assign remaining cases to test/train
-    Test_set =  random.sample(ID_list_Origin, n_test_missing) + ID_list_Target_Ts
-    Train_set = [ID for ID in ID_list_Origin if ID not in Test_set] + ID_list_Target_Tr
-    
     # -------------------------------
-    # Process each patient directory
+    # Scan inputs: ROIs and fingerprint of each phase
     # -------------------------------
-    for iF,RID in tqdm(enumerate(ID_list_Origin),total = len(folder_list)):
-        F = path_origin + RID + "/"
+    scan = {} # RID -> (all_ROIs, {phase: (ROIs, fingerprint)})
+    for RID in ID_list_Origin:
+        F = RID + "/" # Relative to the source
 
         # Read GTV label(s) from GTV.txt file
-        with open(F + "GTV.txt", 'r') as file:
-            all_ROIs = [line.strip() for line in file if line.strip()]
+        all_ROIs = [line.strip() for line in source.read_text(F, "GTV.txt").splitlines() if line.strip()]
 
         # Auto-detect if GTVs are phase-specific (e.g., UNET1_0, UNET2_50)
         auto_detected_phase_specific = all(('_' in roi and roi.split('_')[-1].isdigit()) for roi in all_ROIs)
@@ -157,72 +207,498 @@ def main(path_origin, path_target, delete_origin_data=False, overwrite_converted
         phase_specific = use_phase_specific_gtv_names if use_phase_specific_gtv_names is not None else auto_detected_phase_specific
         
         # Getting each phase for a given  patient ID
-        Phases = [P for P in os.listdir(F) if os.path.isdir(F + P)]
-        OK_to_delete = True
-        
-        print("# phases: ", len(Phases))
+        Phases = source.subfolders(F)
+        scan[RID] = (all_ROIs, {})
         for P in Phases:
-            # Load CT image stack and extract relevant slice metadata
-            dcm_array_crop, dcm_slice_ALL, dcm_SliceLoc, ImagePositionPatient, PixelSpacing = import_US_stack(F + P + "/",SIZE_Z = 0)
-
             # Extract phase suffix (e.g., 0 or 50) from folder name
             phase_suf = ''.join(filter(str.isdigit, P))  # "Phase0" -> "0", "Phase50" -> "50"
             if phase_specific:
                 ROIs = [roi for roi in all_ROIs if roi.endswith("_" + phase_suf)]
-                print("Contours in phase:", len(ROIs))
+            else:
+                ROIs = all_ROIs
             if not ROIs:
                 print(f"WARNING: No ROIs for phase {P} in patient {RID}. Skipping phase...")
                 continue
+            scan[RID][1][P] = (ROIs, phase_fingerprint(F + P + "/", ROIs, hash_inputs, source))
 
-            # Convert RTStruct to binary segmentation mask
-            mask_ROI = import_US_RTS(F + P + "/",dcm_slice_ALL,dcm_SliceLoc,SIZE_Z = 0, ROIs=ROIs)
-
-            # Skip this phase if segmentation failed
-            if isinstance(mask_ROI, int) == False:
-                affine = np.eye(4)
-                affine[0,0] = float(PixelSpacing[1]) #y pixel resolution
-                affine[1,1] = float(PixelSpacing[0]) #x pixel resolution
-                affine[2,2] = np.round(dcm_SliceLoc[1] - dcm_SliceLoc[0],2)*10 #Slice thickness
-                
-                # Setting up save location fror NIfTI files
-                if RID in Train_set:
-                    save_path_im = path_images + RID + "_" + P + "_0000.nii.gz"
-                    save_path_mask = path_labels + RID + "_" + P + ".nii.gz"
-                    save_path_LOC = path_LOC + RID+ "_" + P + "_LOC.pkl"
-                else: # in Test set
-                    save_path_im = path_images_T + RID + "_" + P + "_0000.nii.gz"
-                    save_path_mask = path_labels_T + RID + "_" + P + ".nii.gz"
-                    save_path_LOC = path_LOC_T + RID+ "_" + P + "_LOC.pkl"
-                      
-                # Save image as NIfTI
-                N_img = nib.Nifti1Image(dcm_array_crop, affine)  # Save axis for data (just identity)
-                N_img.header.get_xyzt_units()
-                N_img.to_filename(save_path_im)  # Save as NiBabel file
-                
-                # Save mask as NIfTI
-                N_mask = nib.Nifti1Image(mask_ROI, affine)  # Save axis for data (just identity)
-                N_mask.header.get_xyzt_units()
-                N_mask.to_filename(save_path_mask)  # Save as NiBabel file
-                
-                # Save metadata (used for debugging, resampling, etc.)
-                with open(save_path_LOC , 'wb') as f:
-                    pickle.dump([dcm_slice_ALL, dcm_SliceLoc, ImagePositionPatient, PixelSpacing], f)
-                    
-            else: 
-                print("Error while importing RTS for ID = " + RID)
-                OK_to_delete = False
-
-        # Optionally delete original data to save disk space            
-        if delete_origin_data and OK_to_delete:
-            shutil.rmtree(F)
+    ending = file_ending(output_mode)
+    # Phases converted with other output settings are converted again. "ct_values": the CT volume is written with
+    # the DICOM rescale slope/intercept (read as HU), older conversions wrote the stored pixel values.
+    settings = {"file_ending": ending, "uncropped": write_uncropped, "crop": (bbox_options or {}) if crop else None,
+                "ct_values": "rescaled"}
+    if write_4d:
+        settings["4d"] = True
+    legacy_settings = {"file_ending": ".nii.gz", "uncropped": True, "crop": None}
+    def output_paths(RID, P, split):
+        """Image and mask outputs of a phase, relative to path_target"""
+        return ["images" + split + "/" + RID + "_" + P + "_0000" + ending,
+                "labels" + split + "/" + RID + "_" + P + ending]
+    def pickle_path(RID, P, split):
+        """Slice location pickle of a phase (written before slice_metadata.sqlite), relative to path_target"""
+        return "sliceLOC" + split + "/" + RID+ "_" + P + "_LOC.pkl"
+
+    # Already converted patients keep their split. Outputs of a dataset converted before the manifest
+    # existed are adopted as up to date.
+    manifest = load_manifest(path_target)
+    for RID, (all_ROIs, phases) in scan.items():
+        if RID in manifest["patients"]:
+            continue
+        for split in ["Tr", "Ts"]:
+            done = [P for P in phases if all(os.path.exists(path_target + o) for o in output_paths(RID, P, split) + [pickle_path(RID, P, split)])]
+            if done:
+                manifest["patients"][RID] = {"split": split, "ROIs": all_ROIs, "phases": {P: {"fingerprint": phases[P][1], "outputs": output_paths(RID, P, split), "settings": legacy_settings} for P in done}}
+                break
+
+    # Determine how many total cases and how to split them
+    ID_list_New = [ID for ID in ID_list_Origin if ID not in manifest["patients"]]
+    ID_list_Target_Ts = [ID for ID, entry in manifest["patients"].items() if entry["split"] == "Ts"]
+    total_n_im = len(ID_list_New) + len(manifest["patients"])
+    n_test = int(np.round(total_n_im*(Test_split)))
+    n_test_missing = min(max(n_test - len(ID_list_Target_Ts), 0), len(ID_list_New))
+    
+    # Randomly assign new cases to test/train
+    Test_set = random.sample(ID_list_New, n_test_missing)
+    for RID in ID_list_New:
+        manifest["patients"][RID] = {"split": "Ts" if RID in Test_set else "Tr", "ROIs": scan[RID][0], "phases": {}}
+
+    # Slice metadata of phases converted before slice_metadata.sqlite existed, from their pickles
+    for RID, entry in manifest["patients"].items():
+        for P in entry["phases"]:
+            if RID + "_" + P not in store and os.path.exists(path_target + pickle_path(RID, P, entry["split"])):
+                store.import_pickle(RID + "_" + P, entry["split"], path_target + pickle_path(RID, P, entry["split"]))
+
+    def fill_fingerprints(RID, P, split):
+        """Fingerprint statistics of an up to date phase (and of its crops) converted before they were collected,
+        computed from its output files. False if those files are missing (the phase is then converted again)."""
+        case_id = RID + "_" + P
+        cases = [(store, case_id, [path_target + o for o in output_paths(RID, P, split)])]
+        if crop:
+            cases += [(crop_store, crop_id, [path_crop + d + split + "/" + crop_id + ending for d in ("images", "labels")])
+                      for crop_id in crop_store.crops(case_id)]
+        for case_store, ID, paths in cases:
+            if not case_store.has_fingerprint(ID):
+                if not all(os.path.exists(p) for p in paths):
+                    return False
+                case_store.put_fingerprint(ID, file_fingerprint(*paths))
+        return True
+
+    # -------------------------------
+    # List each new or changed (patient, phase) unit
+    # -------------------------------
+    units = [] # (RID, phase, phase folder, ROIs, split, save_path_im, save_path_mask, metadata_path, crop_paths)
+    fingerprints = {}
+    for RID, (all_ROIs, phases) in scan.items():
+        entry = manifest["patients"][RID]
+        entry["ROIs"] = all_ROIs
+        up_to_date = {}
+        for P, (ROIs, fingerprint) in phases.items():
+            done = entry["phases"].get(P)
+            up_to_date[P] = bool(done and done["fingerprint"] == fingerprint and done.get("settings", legacy_settings) == settings
+                                 and all(os.path.exists(path_target + o) for o in done["outputs"])
+                                 and RID + "_" + P in store and (not crop or RID + "_" + P in crop_store)
+                                 and fill_fingerprints(RID, P, entry["split"]))
+        if write_4d and not all(up_to_date.values()): # The 4D volume needs every phase
+            up_to_date = dict.fromkeys(up_to_date, False)
+        for P, (ROIs, fingerprint) in phases.items():
+            if up_to_date[P]:
+                continue
+            fingerprints[(RID, P)] = fingerprint
+            save_path_im, save_path_mask = (path_target + o for o in output_paths(RID, P, entry["split"]))
+            if not write_uncropped:
+                save_path_im = save_path_mask = None
+            crop_paths = None
+            if crop: # (images dir, labels dir, slice metadata) of the cropped dataset
+                crop_paths = (path_crop + "images" + entry["split"], path_crop + "labels" + entry["split"], path_crop + METADATA_NAME)
+            units.append((RID, P, RID + "/" + P + "/", ROIs, entry["split"], save_path_im, save_path_mask,
+                          path_target + METADATA_NAME, crop_paths))
+    print(f"> {len(units)} (patient, phase) units to convert, {sum(len(phases) for _, phases in scan.values()) - len(units)} up to date")
+    save_manifest(path_target, manifest)
+
+    # -------------------------------
+    # Convert units (optionally in a process pool)
+    # -------------------------------
+    OK_to_delete = {RID: True for RID in ID_list_Origin}
+    units_left = {RID: 0 for RID in ID_list_Origin}
+    for unit in units:
+        units_left[unit[0]] += 1
+    stale = {RID: set() for RID in ID_list_Origin} # Outputs of the previous conversion of the converted phases
+
+    last_save = time.time()
+    def unit_done(unit, outputs):
+        nonlocal last_save
+        RID, P = unit[:2]
+        if outputs is not False:
+            stale[RID].update(manifest["patients"][RID]["phases"].get(P, {}).get("outputs", []))
+            manifest["patients"][RID]["phases"][P] = {"fingerprint": fingerprints[(RID, P)], "settings": settings,
+                                                      "outputs": [os.path.relpath(o, path_target) for o in outputs]}
+            if time.time() - last_save > 10: # Progress survives an interrupted run
+                save_manifest(path_target, manifest)
+                last_save = time.time()
+        else:
+            OK_to_delete[RID] = False
+        units_left[RID] -= 1
+        if units_left[RID] == 0: # Outputs that were not written again (e.g. crops of a removed GTV, other file ending)
+            current = {o for phase in manifest["patients"][RID]["phases"].values() for o in phase["outputs"]}
+            for o in stale[RID] - current:
+                if os.path.exists(path_target + o):
+                    os.remove(path_target + o)
+        # Optionally delete original data to save disk space, once every phase of the patient is done
+        if delete_origin_data and units_left[RID] == 0 and OK_to_delete[RID]:
+            source.delete(RID + "/")
+
+    # Compression threads are shared between the worker processes
+    nifti_options = {"mode": output_mode, "level": compression_level, "threads": max(1, (os.cpu_count() or 1) // max(workers, 1))}
+    report = RunReport(report_path, dataset=full_dataset_name, units=len(units), workers=workers, output_mode=output_mode,
+                       crop=crop) if report_path else None
+    # Patient-level state: shared geometry of the phases, phases waiting for the 4D volume of their patient.
+    # In a process pool, the phases of a patient are converted together by one task.
+    phase_options = {"nifti_options": nifti_options, "bbox_options": bbox_options, "source": source,
+                     "volume_options": {"memory_budget_mb": memory_budget_mb, "scratch_dir": scratch_dir},
+                     "shared_geometry": {} if share_geometry else None,
+                     "volumes4d": Volumes4D(path_target, {RID: units_left[RID] for RID in units_left}, nifti_options) if write_4d else None}
+    with tqdm(total=len(units)) as pbar:
+        if workers > 1:
+            patient_units = {}
+            for unit in units:
+                patient_units.setdefault(unit[0] if share_geometry or write_4d else unit[:2], []).append(unit)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(run_units, group, report is not None, **phase_options): group for group in patient_units.values()}
+                for future in as_completed(futures):
+                    group = futures[future]
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        print(f"Error while converting ID = {group[0][0]}, phases = {[unit[1] for unit in group]}: {e!r}")
+                        results = [(False, [])] * len(group)
+                    for unit, (outputs, records) in zip(group, results):
+                        unit_done(unit, outputs)
+                        if report:
+                            report.add(records)
+                        pbar.update()
+        elif pipeline_depth > 0:
+            for unit, outputs, records in run_pipelined(units, report is not None, depth=pipeline_depth, **phase_options):
+                unit_done(unit, outputs)
+                if report:
+                    report.add(records)
+                pbar.update()
+        else:
+            for unit in units:
+                outputs, records = run_unit(unit, report is not None, **phase_options)
+                unit_done(unit, outputs)
+                if report:
+                    report.add(records)
+                pbar.update()
+
+    save_manifest(path_target, manifest)
+    if report:
+        report.close()
+
+    # Dataset fingerprint statistics, merged from the per-case statistics of the stores
+    write_fingerprint(path_target, store)
+    if crop:
+        write_fingerprint(path_crop, crop_store, cropped=True)
+
+    # Compatibility export of the slice metadata
+    if export_pickles:
+        store.export_pickles(path_target)
+        if crop:
+            crop_store.export_pickles(path_crop)
+    store.close()
+    if crop:
+        crop_store.close()
 
     # Generate nnUNet's dataset.json file        
-    Write_dataset_json(path_target,n_train = n_train*2)
+    if write_uncropped:
+        n_train = sum(len(entry["phases"]) for entry in manifest["patients"].values() if entry["split"] == "Tr")
+        Write_dataset_json(path_target,n_train = n_train, ending = ending)
+    if crop: # One training case per crop
+        crop_images_Tr = os.path.normpath(path_crop + "imagesTr")
+        n_train = sum(os.path.dirname(os.path.normpath(path_target + o)) == crop_images_Tr
+                      for entry in manifest["patients"].values() for phase in entry["phases"].values() for o in phase["outputs"])
+        Write_dataset_json(path_crop,n_train = n_train, ending = ending)
+
+# ===============================
+# Convert one (patient, phase)
+# ===============================
+def run_unit(unit, instrument=False, **options):
+    """convert_phase on a unit of main(), with the stage records of the unit if instrument is True.
+    Returns (outputs of convert_phase, records). An error fails this unit only (outputs = False), as a failed RTStruct import."""
+    log = StageLog(unit[0] + "_" + unit[1]) if instrument else None
+    try:
+        outputs = convert_phase(*unit, log=log, **options)
+    except Exception as e:
+        print(f"Error while converting ID = {unit[0]}, phase = {unit[1]}: {e!r}")
+        if options.get("volumes4d") is not None:
+            options["volumes4d"].failed(unit[0], unit[1], unit[4])
+        outputs = False
+    return outputs, log.records if log else []
+
+def run_units(units, instrument=False, **options):
+    """run_unit on the units of one task of the process pool (the phases of a patient). Returns [(outputs, records), ...].
+    Each unit fails on its own: the phases already written keep their outputs."""
+    return [run_unit(unit, instrument, **options) for unit in units]
+
+def convert_phase(RID, P, folder, ROIs, split, save_path_im, save_path_mask, metadata_path, crop_paths=None, nifti_options=None, bbox_options=None,
+                  log=None, source=None, shared_geometry=None, volumes4d=None, volume_options=None):
+    """Converts one phase folder (CT stack + RTStruct) to a NIfTI image and a NIfTI mask, and adds its slice
+    metadata to the store at metadata_path (slice_metadata.SliceMetadataStore).
+    Returns the list of written files, or False if the RTStruct could not be imported. Runs in a worker process
+    when main() is given workers > 1. nifti_options are passed to nifti_writer.save_nifti (output mode, compression
+    level and threads).
+    -> save_path_im / save_path_mask = None skip the full-size volumes.
+    -> crop_paths = (images dir, labels dir, slice metadata path) also writes the volumes cropped around the
+       mask structures (Nifti_cropping.crop_images with bbox_options) to the cropped dataset.
+    -> log (instrumentation.StageLog) records the time, bytes and memory of each stage.
+    -> source (dicom_sources) is the directory or archive folder is relative to (None: folder is a path).
+    -> shared_geometry (dict kept across the phases of a patient) and volumes4d (Volumes4D): see load_phase and write_phase.
+    -> volume_options = {"memory_budget_mb", "scratch_dir"} are passed to import_US_stack.
+    """
+    phase = load_phase(RID, folder, ROIs, log=log, source=source, shared_geometry=shared_geometry, volume_options=volume_options)
+    if phase is False:
+        if volumes4d is not None:
+            volumes4d.add(RID, P, split, None, None)
+        return False
+    return write_phase(RID, P, split, phase, save_path_im, save_path_mask, metadata_path, crop_paths, nifti_options, bbox_options, log, volumes4d)
+
+def load_phase(RID, folder, ROIs, log=None, source=None, shared_geometry=None, volume_options=None):
+    """Reads and converts one phase folder in memory (first half of convert_phase).
+    Returns (NIfTI image, NIfTI mask, fingerprint statistics, slice metadata), or False if the RTStruct could not be imported.
+    -> shared_geometry is a dict kept across the phases of a patient: the first phase of the patient stores its
+       geometry there, the next ones reuse it when they have the same slices (import_US_stack_shared).
+    """
+    # Load CT image stack and extract relevant slice metadata
+    stack = None
+    if shared_geometry is not None and shared_geometry.get("RID") == RID:
+        stack = import_US_stack_shared(folder, shared_geometry["stack"], log = log, source = source)
+    if stack is None:
+        stack = import_US_stack(folder,SIZE_Z = 0, log = log, source = source, **(volume_options or {}))
+        if shared_geometry is not None and shared_geometry.get("RID") != RID: # Only the current patient is kept
+            shared_geometry.update(RID = RID, stack = stack[1:] + (stack[0].dtype, stack[0].shape[:2]))
+    dcm_array_crop, dcm_slice_ALL, dcm_SliceLoc, ImagePositionPatient, PixelSpacing, geometry = stack
+    del stack
+
+    # The slice spacing needs at least 2 kept slices (non-empty, without the first and last ones)
+    if len(dcm_SliceLoc) < 2:
+        print(f"Error while importing CT for ID = {RID}: {len(dcm_SliceLoc)} slice(s) kept, folder = {folder}")
+        return False
+
+    # Convert RTStruct to binary segmentation mask, on the geometry of the already loaded CT stack
+    mask_ROI = import_US_RTS(folder,dcm_slice_ALL,dcm_SliceLoc,SIZE_Z = 0, ROIs=ROIs, geometry=geometry, log=log, source=source)
+
+    # Skip this phase if segmentation failed
+    if isinstance(mask_ROI, int):
+        print("Error while importing RTS for ID = " + RID)
+        return False
+
+    affine = np.eye(4)
+    affine[0,0] = float(PixelSpacing[1]) #y pixel resolution
+    affine[1,1] = float(PixelSpacing[0]) #x pixel resolution
+    affine[2,2] = np.round(geometry["kept"].spacing(),2)*10 #Slice thickness
+                      
+    # Save image as NIfTI
+    N_img = nib.Nifti1Image(dcm_array_crop, affine)  # Save axis for data (just identity)
+    N_img.header.set_slope_inter(*geometry["rescale"]) # Stored values stay in the DICOM pixel type
+    N_img.header.get_xyzt_units()
+    N_mask = nib.Nifti1Image(mask_ROI, affine)  # Save axis for data (just identity)
+    N_mask.header.get_xyzt_units()
+
+    # Fingerprint statistics of the full-size volume (fingerprint.py), from the arrays already in memory
+    with stage(log, "fingerprint"):
+        fingerprint = case_fingerprint(dcm_array_crop, *geometry["rescale"], mask_ROI, N_img.header.get_zooms()[:3])
+    return N_img, N_mask, fingerprint, (dcm_slice_ALL, dcm_SliceLoc, ImagePositionPatient, PixelSpacing)
+
+def write_phase(RID, P, split, phase, save_path_im, save_path_mask, metadata_path, crop_paths=None, nifti_options=None, bbox_options=None, log=None,
+                volumes4d=None):
+    """Writes a phase loaded by load_phase: NIfTI files, crops and slice metadata (second half of convert_phase).
+    With volumes4d (Volumes4D), the phase is also kept for the 4D volume of its patient, written with its last phase.
+    Returns the list of written files."""
+    N_img, N_mask, fingerprint, slice_metadata = phase
+    written = []
+    if save_path_im is not None:
+        with stage(log, "write_nifti") as record:
+            save_nifti(N_img, save_path_im, **(nifti_options or {}))
+            save_nifti(N_mask, save_path_mask, **(nifti_options or {}))
+            written += [save_path_im, save_path_mask]
+            if log:
+                record["bytes_written"] = file_bytes(written)
+
+    # Crop the in-memory volumes for the cropped dataset
+    metadata_paths = [metadata_path]
+    if crop_paths is not None:
+        written += crop_images(N_img, N_mask, RID + "_" + P, crop_paths[0], crop_paths[1], nifti_options, bbox_options,
+                               metadata=crop_paths[2], log=log)
+        metadata_paths.append(crop_paths[2])
+    
+    # Save metadata (used for debugging, resampling, etc.)
+    with stage(log, "metadata"):
+        for path in metadata_paths:
+            with SliceMetadataStore(path) as store:
+                store.put_case(RID + "_" + P, split, *slice_metadata)
+        with SliceMetadataStore(metadata_path) as store:
+            store.put_fingerprint(RID + "_" + P, fingerprint)
+    if volumes4d is not None:
+        with stage(log, "write_4d") as record:
+            written_4d = volumes4d.add(RID, P, split, N_img, N_mask)
+            if log and written_4d:
+                record["bytes_written"] = file_bytes(written_4d)
+        written += written_4d
+    return written
+
+class Volumes4D:
+    """Phases of each patient waiting for its 4D volume. Once all the phases of a patient are added, they are
+    stacked (phases in numerical order) and written to images4D<split>/<RID>_0000 and labels4D<split>/<RID>.
+    No volume is written for a patient whose phases failed or differ in shape, affine or scaling."""
+    def __init__(self, path_target, n_phases, nifti_options=None):
+        self.path_target = path_target
+        self.n_phases = n_phases # RID -> number of phases to add
+        self.nifti_options = nifti_options or {}
+        self.phases = {}
+        self.done = set() # Patients whose 4D volume was written (or given up)
+
+    def add(self, RID, P, split, N_img, N_mask):
+        """Adds a phase (N_img = None for a failed phase). Returns the paths written (once the patient is complete)."""
+        phases = self.phases.setdefault(RID, {})
+        phases[P] = (N_img, N_mask)
+        if len(phases) < self.n_phases[RID]:
+            return []
+        del self.phases[RID]
+        self.done.add(RID)
+        order = sorted(phases, key=lambda P: (int(''.join(filter(str.isdigit, P)) or -1), P))
+        images = [phases[P] for P in order]
+        first = images[0][0]
+        if any(img is None or img.shape != first.shape or not np.allclose(img.affine, first.affine)
+               or img.header.get_slope_inter() != first.header.get_slope_inter() for img, _ in images):
+            print(f"WARNING: phases of patient {RID} failed or differ, no 4D volume written")
+            return []
+        ending = file_ending(self.nifti_options.get("mode", "gzip"))
+        paths = [self.path_target + "images4D" + split + "/" + RID + "_0000" + ending, self.path_target + "labels4D" + split + "/" + RID + ending]
+        N_img4 = nib.Nifti1Image(np.stack([np.asanyarray(img.dataobj) for img, _ in images], axis=-1), first.affine)
+        N_img4.header.set_slope_inter(*first.header.get_slope_inter())
+        N_mask4 = nib.Nifti1Image(np.stack([np.asanyarray(mask.dataobj) for _, mask in images], axis=-1), first.affine)
+        for path, img in zip(paths, [N_img4, N_mask4]):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            save_nifti(img, path, **self.nifti_options)
+        return paths
+
+    def failed(self, RID, P, split):
+        """Adds a phase whose conversion raised, unless it was already added"""
+        if RID not in self.done and P not in self.phases.get(RID, {}):
+            self.add(RID, P, split, None, None)
+
+def run_pipelined(units, instrument=False, depth=2, source=None, **options):
+    """Converts units in this process as a reader -> converter -> writer pipeline: a reader thread prefetches the
+    files of the next phases (dicom_sources.prefetch) and a writer thread writes the previous phase (write_phase)
+    while the current one is converted (load_phase). At most `depth` phases wait in each queue, which caps memory.
+    Yields (unit, outputs of convert_phase, stage records), in the order of units. As in run_unit, an error in the
+    prefetch, conversion or writing of a phase fails that unit only (outputs = False).
+    """
+    logs = [StageLog(unit[0] + "_" + unit[1]) if instrument else None for unit in units]
+    read_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def reader():
+        for n, unit in enumerate(units):
+            if stop.is_set():
+                return
+            try:
+                with stage(logs[n], "prefetch") as record:
+                    files = prefetch(source, unit[2])
+                    record["bytes_read"] = files.nbytes()
+            except Exception as e: # Raised again in the converter, in order
+                files = e
+            while True: # Gives up once the converter stopped, so that the prefetched files are released
+                try:
+                    read_queue.put((n, unit, files), timeout=0.1)
+                    break
+                except queue.Full:
+                    if stop.is_set():
+                        return
+
+    def write(unit, phase, log):
+        """write_phase in the writer thread, which owns volumes4d. Returns False for a failed phase."""
+        RID, P, _, _, split, save_path_im, save_path_mask, metadata_path, crop_paths = unit
+        volumes4d = options.get("volumes4d")
+        try:
+            if phase is not False:
+                return write_phase(RID, P, split, phase, save_path_im, save_path_mask, metadata_path, crop_paths,
+                                   options.get("nifti_options"), options.get("bbox_options"), log, volumes4d)
+        except Exception as e:
+            print(f"Error while writing ID = {RID}, phase = {P}: {e!r}")
+        if volumes4d is not None:
+            volumes4d.failed(RID, P, split)
+        return False
+
+    def finish(unit, log, future):
+        return unit, future.result(), log.records if log else []
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    pending = collections.deque() # (unit, log, future) of the phases being written
+    try:
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            for _ in units:
+                n, unit, files = read_queue.get()
+                RID, P, folder, ROIs = unit[:4]
+                try:
+                    if isinstance(files, Exception): # Prefetch failed
+                        raise files
+                    phase = load_phase(RID, folder, ROIs, log=logs[n], source=files, shared_geometry=options.get("shared_geometry"),
+                                       volume_options=options.get("volume_options"))
+                except Exception as e:
+                    print(f"Error while converting ID = {RID}, phase = {P}: {e!r}")
+                    phase = False
+                del files
+                pending.append((unit, logs[n], writer.submit(write, unit, phase, logs[n])))
+                del phase
+                # Backpressure: wait for the oldest write once `depth` phases are waiting
+                while pending and (len(pending) >= depth or pending[0][2].done()):
+                    yield finish(*pending.popleft())
+            while pending:
+                yield finish(*pending.popleft())
+    finally:
+        # The converter raised or the caller closed the generator: stop the reader and drop the prefetched phases
+        stop.set()
+        while thread.is_alive():
+            try:
+                read_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
             
+# ===========================
+# Conversion manifest
+# ===========================
+MANIFEST_NAME = "conversion_manifest.json"
+
+def phase_fingerprint(folder, ROIs, hash_contents=False, source=None):
+    """Fingerprint of the inputs of one phase: names, sizes and mtimes of its files (optionally their
+    contents) and the ROI names read from GTV.txt. Any change in these triggers a reconversion.
+    """
+    source = source or open_source("")
+    h = hashlib.sha1(json.dumps(ROIs).encode())
+    for name, size, mtime, member in source.files(folder):
+        h.update(f"{name}|{size}|{mtime}\n".encode())
+        if hash_contents:
+            with source.open(member) as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+    return h.hexdigest()
+
+def load_manifest(path_target):
+    if os.path.exists(path_target + MANIFEST_NAME):
+        with open(path_target + MANIFEST_NAME, 'r') as f:
+            return json.load(f)
+    return {"patients": {}}
+
+def save_manifest(path_target, manifest):
+    """Writes the manifest atomically (temp file + rename) so an interrupted run never leaves it truncated."""
+    with open(path_target + MANIFEST_NAME + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path_target + MANIFEST_NAME + ".tmp", path_target + MANIFEST_NAME)
+
 # ========================
 # JSON Config for nnUNet
 # ========================          
-def Write_dataset_json(path_target,n_train):
+def Write_dataset_json(path_target,n_train,ending = ".nii.gz"):
     Base_json = """{ 
  "channel_names": {
    "0": "CT" 
@@ -232,7 +708,7 @@ def Write_dataset_json(path_target,n_train):
    "GTV": [1]
  }, 
  "numTraining": """ + str(n_train) + """, 
- "file_ending": ".nii.gz"
+ "file_ending": """ + json.dumps(ending) + """
 }"""
     
     with open(path_target  + 'dataset.json', 'w') as file:
@@ -242,114 +718,325 @@ def Write_dataset_json(path_target,n_train):
 # ========================
 # Load DICOM CT Stack
 # ========================
-def import_US_stack(folder,SIZE_Z,im_size = (512,512)):
-    dcm_list = glob.glob(folder + 'CT*.dcm')
+def read_CT_headers(dcm_list, source=None):
+    """Read the headers of a CT series without decoding its pixel data.
+    Returns a list of (SliceLocation [cm], file path, header) sorted by slice location.
+    """
+    source = source or open_source("")
+    headers = []
+    for l in dcm_list:
+        with source.open(l) as f:
+            ds = pydicom.dcmread(f, stop_before_pixels=True)
+        headers.append((float(ds.SliceLocation)/10, l, ds))
+    headers.sort(key=lambda h: h[0])
+    return headers
+
+class SliceIndex:
+    """Slice positions with a tolerance-aware lookup, built once per phase.
+    Replaces exact float matching (`in` + `list.index`, `np.where(==)`), which is O(n²) over the slices
+    and silently drops slices whose positions differ by rounding.
+    Positions can be in any order (ImagePositionPatient z decreases with SliceLocation for some patient positions
+    and vendors): they are searched sorted, indices refer to the order they were given in.
+    """
+    def __init__(self, positions, tol=1e-3):
+        positions = np.asarray(positions, dtype=float)
+        self.order = np.argsort(positions, kind="stable")
+        self.positions = positions[self.order]
+        self.tol = tol
+
+    def __len__(self):
+        return len(self.positions)
+
+    def lookup(self, values):
+        """Index of the position closest to each value, or -1 where none is within tol."""
+        values = np.asarray(values, dtype=float)
+        if len(self.positions) == 0:
+            return np.full(values.shape, -1)
+        right = np.clip(np.searchsorted(self.positions, values), 0, len(self.positions) - 1)
+        left = np.maximum(right - 1, 0)
+        nearest = np.where(np.abs(self.positions[left] - values) <= np.abs(self.positions[right] - values), left, right)
+        return np.where(np.abs(self.positions[nearest] - values) <= self.tol, self.order[nearest], -1)
+
+    def spacing(self):
+        """Median distance between consecutive positions"""
+        return float(np.median(np.diff(self.positions)))
+
+def series_geometry(headers):
+    """Geometry of a sorted CT series (see read_CT_headers), shared by the image and mask paths.
+    "z" indexes the positions [mm] of all the slices of the series; import_US_stack adds "kept",
+    the index of the SliceLocation [cm] of the slices kept in the volume.
+    """
+    ds = headers[0][2]
+    z = np.array([float(h[2].ImagePositionPatient[2]) for h in headers])
+    return {"z": SliceIndex(z, tol=np.median(np.abs(np.diff(z)))/2 if len(z) > 1 else np.inf),
+            "SOPInstanceUID": {h[2].SOPInstanceUID: i for i,h in enumerate(headers)},
+            "origin": np.array(ds.ImagePositionPatient, dtype=float),
+            "orientation": np.array(ds.ImageOrientationPatient, dtype=float),
+            "PixelSpacing": np.array(ds.PixelSpacing, dtype=float),
+            "shape": (int(ds.Rows), int(ds.Columns)),
+            "rescale": (float(getattr(ds, "RescaleSlope", 1)), float(getattr(ds, "RescaleIntercept", 0)))}
+
+def new_volume(shape, dtype, on_disk=False, scratch_dir=None):
+    """Zero-filled volume, in Fortran order so that each slice (last axis) is contiguous, as in the NIfTI file.
+    on_disk = True backs it with a temporary file of scratch_dir (np.memmap), removed once the volume is released."""
+    if not on_disk:
+        return np.zeros(shape, dtype=dtype, order="F")
+    return np.memmap(tempfile.TemporaryFile(dir=scratch_dir), dtype=dtype, mode="w+", shape=shape, order="F")
+
+def import_US_stack(folder,SIZE_Z,im_size = None,log = None,source = None,memory_budget_mb = None,scratch_dir = None):
+    """Loads the CT stack of a phase folder. The matrix size is read from the headers unless im_size is given.
+    If the image and mask volumes would exceed memory_budget_mb, they are disk-backed (see new_volume).
+    """
+    source = source or open_source("") # folder is a path
+    dcm_list = source.glob(folder, 'CT*.dcm')
     print(f"# CT scans found: {len(dcm_list)}")
     if len(dcm_list) == 0:
-        dcm_list = glob.glob(folder + '/US*.dcm') # For Ultrasounds
+        dcm_list = source.glob(folder, 'US*.dcm') # For Ultrasounds
+
+    # Header pass: sorted slice geometry (SliceLocation, ImagePositionPatient, PixelSpacing, Rows/Columns)
+    with stage(log, "ct_headers", slices=len(dcm_list)):
+        headers = read_CT_headers(dcm_list, source)
+        geometry = series_geometry(headers)
+    dcm_slice_ALL = [h[0] for h in headers] #To use with RTStruct
+    ds = headers[0][2]
+    im_size = im_size or geometry["shape"]
     threshold = im_size[0]*im_size[1] * 0.687
-    
+
+    # Pixel pass: every slice is decoded exactly once, in sorted order, straight into the next free
+    # position of the volume. Empty slices and the first nonempty slice get overwritten by the next one.
+    # Volume kept in the stored DICOM pixel type (e.g. int16), rescale slope/intercept go to the NIfTI header.
+    # Slices with different rescales are converted to HU (float32) one by one instead.
+    stored_dtype = np.dtype(("int" if ds.PixelRepresentation else "uint") + str(ds.BitsAllocated))
+    rescales = [(float(getattr(h[2], "RescaleSlope", 1)), float(getattr(h[2], "RescaleIntercept", 0))) for h in headers]
+    per_slice = any(r != geometry["rescale"] for r in rescales)
+    if per_slice:
+        print(f"WARNING: CT slices have different rescale slope/intercept, volume converted to HU, folder = {folder}")
+        stored_dtype = np.dtype(np.float32)
+        geometry["rescale"] = (1.0, 0.0)
+    shape = (im_size[0],im_size[1],max(len(headers),SIZE_Z))
+    on_disk = memory_budget_mb is not None and np.prod(shape) * (stored_dtype.itemsize + 1) > memory_budget_mb * 1e6 # Image + uint8 mask
+    geometry["volumes"] = (on_disk, scratch_dir) # Also used for the mask
+    dcm_array = new_volume(shape, stored_dtype, *geometry["volumes"])
+    dcm_slice_nonemp = []
+    first_nonemp_found = False
+    with stage(log, "ct_pixels", slices=len(headers)) as record:
+        for (sl,l,_), (slope,inter) in zip(headers, rescales):
+            n = len(dcm_slice_nonemp)
+            with source.open(l) as f:
+                dcm_array_i = pydicom.dcmread(f).pixel_array
+            dcm_array[:,:,n] = dcm_array_i * np.float32(slope) + np.float32(inter) if per_slice else dcm_array_i
+            if np.count_nonzero(dcm_array_i == 0) < threshold:
+                if first_nonemp_found:
+                    dcm_slice_nonemp.append(sl)
+                first_nonemp_found = True #Removing first nonempty slice
+        if log:
+            record["bytes_read"] = sum(source.size(l) for l in dcm_list)
+    if dcm_slice_nonemp:
+        dcm_slice_nonemp.pop() #Removing last nonempty slice
+    n = len(dcm_slice_nonemp)
+    dcm_array[:,:,n:] = 0
+
     if SIZE_Z > 0:
-        dcm_array = np.zeros((im_size[0],im_size[1],SIZE_Z)) #0 padding to make size = SIZE_Z
-        
-        #Reading all slices, but only keeping non-empty ones
-        dcm_slice_ALL = [] #To use with RTStruct
-        dcm_slice_nonemp = []
-        for i,l in enumerate(dcm_list):
-            ds = pydicom.dcmread(l)
-            dcm_array_i = ds.pixel_array
-            dcm_slice_ALL.append(float(ds.SliceLocation)/10)
-            # print(np.sum(dcm_array_i == 0))
-            if np.sum(dcm_array_i == 0) < threshold:
-                dcm_slice_nonemp.append(float(ds.SliceLocation)/10)
-        dcm_slice_ALL.sort()
-        for k in range(2):
-            if k == 0: dcm_slice_nonemp.sort(reverse = True)
-            else: dcm_slice_nonemp.sort()
-            dcm_slice_nonemp.pop() #Removing first and last nonempty slice
-        if len(dcm_slice_nonemp) >= SIZE_Z: #Keeping only SIZE_Z images
+        if n >= SIZE_Z: #Keeping only SIZE_Z images
             dcm_SliceLoc = np.array(dcm_slice_nonemp[-SIZE_Z:])
-        else:
+            dcm_array = dcm_array[:,:,n-SIZE_Z:n]
+        else: #0 padding to make size = SIZE_Z
             dcm_SliceLoc = np.ones(SIZE_Z)*10000
-            dcm_SliceLoc[0:len(dcm_slice_nonemp)] = dcm_slice_nonemp
-        for i,l in enumerate(dcm_list):
-            ds = pydicom.dcmread(l)
-            dcm_index = np.where(dcm_SliceLoc == float(ds.SliceLocation)/10)[0]
-            if len(dcm_index) == 1:
-                dcm_array[:,:,dcm_index[0]] = ds.pixel_array
+            dcm_SliceLoc[0:n] = dcm_slice_nonemp
+            dcm_array = dcm_array[:,:,:SIZE_Z]
     else:
-        #Reading all slices, but only keeping non-empty ones
-        dcm_slice_ALL = [] #To use with RTStruct
-        dcm_slice_nonemp = []
-        for i,l in enumerate(dcm_list):
-            ds = pydicom.dcmread(l)
-            dcm_array_i = ds.pixel_array
-            dcm_slice_ALL.append(float(ds.SliceLocation)/10)
-            # print(np.sum(dcm_array_i == 0))
-            if np.sum(dcm_array_i == 0) < threshold:
-                dcm_slice_nonemp.append(float(ds.SliceLocation)/10)
-        dcm_slice_ALL.sort()
-        for k in range(2):
-            if k == 0: dcm_slice_nonemp.sort(reverse = True)
-            else: dcm_slice_nonemp.sort()
-            dcm_slice_nonemp.pop() #Removing first and last nonempty slice
         dcm_SliceLoc = dcm_slice_nonemp[:]
-        dcm_array = np.zeros((im_size[0],im_size[1],len(dcm_SliceLoc))) #0 padd
-        for i,l in enumerate(dcm_list):
-            ds = pydicom.dcmread(l)
-            if float(ds.SliceLocation)/10 in dcm_SliceLoc:
-                dcm_index = dcm_SliceLoc.index(float(ds.SliceLocation)/10)
-                dcm_array[:,:,dcm_index] = ds.pixel_array
+        dcm_array = dcm_array[:,:,:n]
+
+    geometry["kept"] = SliceIndex(dcm_SliceLoc)
+
+    return dcm_array, dcm_slice_ALL, dcm_SliceLoc, ds.ImagePositionPatient, ds.PixelSpacing, geometry
 
-    return dcm_array, dcm_slice_ALL, dcm_SliceLoc, ds.ImagePositionPatient, ds.PixelSpacing
+def import_US_stack_shared(folder, reference, log = None, source = None):
+    """import_US_stack for a phase with the same slices as an already converted phase of the patient.
+    reference = the outputs of import_US_stack for that phase, without the volume, + (dtype, matrix size).
+    Each slice is read once (no separate header pass) and goes to the position of the reference slice at the same
+    location: the slice selection, slice index and spacing of the reference are reused.
+    Returns None if the phase does not have the same slices, matrix, orientation or scaling (use import_US_stack).
+    """
+    source = source or open_source("")
+    dcm_slice_ALL, dcm_SliceLoc, ImagePositionPatient, PixelSpacing, ref, dtype, im_size = reference
+    dcm_list = source.glob(folder, 'CT*.dcm') or source.glob(folder, 'US*.dcm')
+    if len(dcm_list) != len(dcm_slice_ALL):
+        return None
+    print(f"# CT scans found: {len(dcm_list)} (shared patient geometry)")
+    dcm_array = new_volume(im_size + (len(dcm_SliceLoc),), dtype, *ref["volumes"])
+    uids, seen = {}, set()
+    with stage(log, "ct_pixels", slices=len(dcm_list), shared=True) as record:
+        for l in dcm_list:
+            with source.open(l) as f:
+                ds = pydicom.dcmread(f)
+            i = int(ref["z"].lookup(float(ds.ImagePositionPatient[2])))
+            if (i < 0 or i in seen or abs(float(ds.SliceLocation)/10 - dcm_slice_ALL[i]) > 1e-3
+                    or (int(ds.Rows), int(ds.Columns)) != ref["shape"]
+                    or not np.allclose(np.array(ds.PixelSpacing, dtype=float), ref["PixelSpacing"])
+                    or not np.allclose(np.array(ds.ImageOrientationPatient, dtype=float), ref["orientation"])
+                    or (float(getattr(ds, "RescaleSlope", 1)), float(getattr(ds, "RescaleIntercept", 0))) != ref["rescale"]):
+                print(f"Phase geometry differs from the patient geometry, folder = {folder}")
+                return None
+            uids[ds.SOPInstanceUID] = i
+            seen.add(i)
+            n = int(ref["kept"].lookup(float(ds.SliceLocation)/10))
+            if n >= 0:
+                dcm_array[:,:,n] = ds.pixel_array
+        if log:
+            record["bytes_read"] = sum(source.size(l) for l in dcm_list)
+    geometry = dict(ref, SOPInstanceUID = uids)
+    return dcm_array, dcm_slice_ALL, dcm_SliceLoc, ImagePositionPatient, PixelSpacing, geometry
 
 # ========================
 # Load RTStruct Masks
 # ========================
-def import_US_RTS(folder,dcm_slice_ALL,dcm_SliceLoc,SIZE_Z,ROIs,im_size = (512,512)):
-    dcm_SliceLoc = list(dcm_SliceLoc)
-    
+def read_RTS_contours(rts_path, ROIs, source=None):
+    """Read the contours of the requested ROIs from an RTStruct file.
+    Returns {ROI name: [(referenced SOPInstanceUID or None, (N,3) array of points in mm), ...]}.
+    Only the ContourSequence of the requested ROIs is converted to arrays.
+    """
+    with (source or open_source("")).open(rts_path) as f:
+        rts = pydicom.dcmread(f)
+    numbers = {int(roi.ROINumber): roi.ROIName for roi in rts.StructureSetROISequence if roi.ROIName in ROIs}
+    contours = {name: [] for name in numbers.values()}
+    for roi_contour in rts.ROIContourSequence:
+        name = numbers.get(int(roi_contour.ReferencedROINumber))
+        if name is None:
+            continue
+        for contour in getattr(roi_contour, "ContourSequence", []):
+            ref_uid = contour.ContourImageSequence[0].ReferencedSOPInstanceUID if "ContourImageSequence" in contour else None
+            contours[name].append((ref_uid, np.asarray(contour.ContourData, dtype=float).reshape(-1, 3)))
+    return contours
+
+def fill_polygons(slice_mask, polygons):
+    """Fill integer pixel polygons [(cols, rows), ...] into a 2D mask, in place.
+    Same pixels as cv2.fillPoly of OpenCV 4.x (8-connected outlines) for polygons inside the slice: even-odd filling
+    over all polygons of the slice, outlines included (checked in benchmark_pipeline.py when cv2 is installed).
+    OpenCV 5 rounds row crossings exactly halfway between two pixels down, so pixels at the left and right ends of
+    such rows can differ. cv2 also clips edges that leave the slice before drawing them, so pixels next to the slice
+    border can differ for those.
+    """
+    H, W = slice_mask.shape
+    # Edges from each vertex to the next
+    edges = np.concatenate([np.stack([np.roll(c, 1), np.roll(r, 1), c, r], axis=1) for c, r in polygons]).astype(np.int64)
+    x0, y0, x1, y1 = edges.T
+
+    # Interior: scanline through each row. Each non-horizontal edge crosses the rows from its top (included) to its
+    # bottom (excluded). As in cv2, x is stepped in 16 bit fixed point from the top (step truncated toward zero) and
+    # rounded to the nearest pixel, half up. Pixels between pairs of crossings.
+    x0, y0, x1, y1 = edges[y0 != y1].T
+    top, height = np.minimum(y0, y1), np.abs(y1 - y0)
+    x_top = np.where(y0 < y1, x0, x1)
+    step = (x1 - x0) * np.sign(y1 - y0) # x_bottom - x_top
+    step = np.sign(step) * ((np.abs(step) << 16) // np.maximum(height, 1))
+    rows = np.arange(max(top.min(initial=0), 0), min((top + height).max(initial=0), H))
+    if len(rows):
+        Y = rows[:, None]
+        none = np.iinfo(np.int64).max
+        X = np.where((top <= Y) & (Y < top + height), ((x_top << 16) + (Y - top) * step + (1 << 15)) >> 16, none)
+        X.sort(axis=1)
+        n_pairs = X.shape[1] // 2
+        starts, stops = X[:, 0:2*n_pairs:2], X[:, 1:2*n_pairs:2]
+        r_idx, p_idx = np.nonzero(stops != none)
+        starts = np.clip(starts[r_idx, p_idx], 0, W)
+        stops = np.clip(stops[r_idx, p_idx] + 1, 0, W)
+        runs = np.zeros((len(rows), W + 1), dtype=np.int32)
+        np.add.at(runs, (r_idx, starts), 1)
+        np.add.at(runs, (r_idx, stops), -1)
+        slice_mask[rows] |= np.cumsum(runs[:, :W], axis=1) > 0
+
+    # Outlines: 8-connected lines drawn from the left end of each edge (Bresenham). Along the major axis, pixel k is
+    # offset by ceil(k * minor / major - 1/2) on the minor axis.
+    x0, y0, x1, y1 = edges.T
+    swap = x1 < x0
+    xs, ys = np.where(swap, x1, x0), np.where(swap, y1, y0)
+    dx, dy = np.abs(x1 - x0), np.where(swap, y0 - y1, y1 - y0)
+    x_major = dx >= np.abs(dy)
+    major, minor = np.maximum(dx, np.abs(dy)), np.minimum(dx, np.abs(dy))
+    n = major + 1
+    k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    major, minor = np.repeat(major, n), np.repeat(minor, n)
+    offset = -((major - 2 * k * minor) // np.maximum(2 * major, 1))
+    along, across = np.where(np.repeat(x_major, n), k, offset), np.where(np.repeat(x_major, n), offset, k)
+    cols = np.repeat(xs, n) + along
+    rows = np.repeat(ys, n) + np.repeat(np.sign(dy), n) * across
+    inside = (cols >= 0) & (cols < W) & (rows >= 0) & (rows < H)
+    slice_mask[rows[inside], cols[inside]] = True
+
+def rasterize_contours(contours, geometry):
+    """Rasterize one ROI's contours on the CT series described by `geometry` (see series_geometry).
+    Returns {index in the sorted series: 2D boolean slice mask}, only for slices with contours.
+    """
+    row_dir, col_dir = geometry["orientation"][:3], geometry["orientation"][3:]
+    per_slice = {}
+    for ref_uid, points in contours:
+        if ref_uid in geometry["SOPInstanceUID"]:
+            i = geometry["SOPInstanceUID"][ref_uid]
+        else: # No (known) referenced image: slice at the contour position
+            i = int(geometry["z"].lookup(points[0, 2]))
+            if i < 0:
+                continue
+        # Patient coordinates [mm] -> pixel (column, row) indices
+        rel = points - geometry["origin"]
+        cols = np.around(rel @ row_dir / geometry["PixelSpacing"][1])
+        rows = np.around(rel @ col_dir / geometry["PixelSpacing"][0])
+        per_slice.setdefault(i, []).append((cols, rows))
+
+    masks = {}
+    for i, polygons in per_slice.items():
+        masks[i] = np.zeros(geometry["shape"], dtype=bool)
+        fill_polygons(masks[i], polygons)
+    return masks
+
+def import_US_RTS(folder,dcm_slice_ALL,dcm_SliceLoc,SIZE_Z,ROIs,im_size = None,geometry = None,log = None,source = None):
+    """Build the mask of the ROIs from the RTStruct of a phase folder.
+    `geometry` is the CT series geometry returned by import_US_stack; it is read from the CT headers if not given.
+    The matrix size is the one of the CT series unless im_size is given; the mask is disk-backed like the CT volume.
+    `source` (dicom_sources) is the directory or archive folder is relative to (None: folder is a path).
+    """
+    source = source or open_source("")
     if SIZE_Z == 0 :
         SIZE_Z = len(dcm_SliceLoc)
     
-    if len(ROIs) == 1:
-        mask_ROI = np.zeros((im_size[0],im_size[1],SIZE_Z))
-    else:
-        mask_ROI = np.zeros((len(ROIs),im_size[0],im_size[1],SIZE_Z))
-    rts_list = glob.glob(folder + 'RS*.dcm')
+    rts_list = source.glob(folder, 'RS*.dcm')
     print(f"RTS files found: {len(rts_list)}")
+    if not rts_list:
+        print("No RT struct, folder = " + folder)
+        return 0
     
     # Match RS*.dcm files — you may need to update this if your files are named differently
-    size_rts = os.path.getsize(rts_list[0])
+    size_rts = source.size(rts_list[0])
     if size_rts < 20000:
         print("Empty RT struct, folder = " + folder)
         return 0
     else: #More than 20ko, typical if not empty
-        # Parse RTStruct
-        rtstruct = RTStructBuilder.create_from(
-              dicom_series_path=folder, 
-              rt_struct_path=rts_list[0]
-            )
-        
-        for iR,ROI in enumerate(ROIs):
-            if ROI in rtstruct.get_roi_names():
-                TEMP = rtstruct.get_roi_mask_by_name(ROI)
-            else: 
-                print("Missing ROI! " + ROI + ", folder = " + folder)
-                return 0
-        
-            for i,sl in enumerate(dcm_slice_ALL):
-                if sl in dcm_SliceLoc:
-                    dcm_index = dcm_SliceLoc.index(sl)
-                    if len(ROIs) == 1:
-                        mask_ROI[:,:,dcm_index] = TEMP[:,:,i]
-                    else:
-                        mask_ROI[iR,:,:,dcm_index] = TEMP[:,:,i]
+        if geometry is None:
+            geometry = series_geometry(read_CT_headers(source.glob(folder, 'CT*.dcm'), source))
+            geometry["kept"] = SliceIndex(dcm_SliceLoc)
+        # Position of each series slice in the volume (-1 if not kept)
+        dcm_index_ALL = geometry["kept"].lookup(dcm_slice_ALL)
+
+        # Parse only the requested ROIs of the RTStruct
+        with stage(log, "rtstruct_parse", bytes_read=size_rts):
+            contours = read_RTS_contours(rts_list[0], ROIs, source)
+
+        # Single label volume, all structures of the phase are OR-ed into it
+        with stage(log, "mask_assembly", rois=len(ROIs)):
+            im_size = im_size or geometry["shape"]
+            mask_ROI = new_volume((im_size[0],im_size[1],SIZE_Z), np.uint8, *geometry.get("volumes", (False, None)))
+            for ROI in ROIs:
+                if ROI not in contours:
+                    print("Missing ROI! " + ROI + ", folder = " + folder)
+                    return 0
+            
+                # Only slices with contours are filled
+                for i,slice_mask in rasterize_contours(contours[ROI], geometry).items():
+                    dcm_index = dcm_index_ALL[i]
+                    if dcm_index >= 0:
+                        mask_ROI[:,:,dcm_index] |= slice_mask
                      
-        # return mask_ROI
-        if mask_ROI.ndim == 4:
-            return np.any(mask_ROI, axis=0).astype(np.uint8) # combining all structures in a phase
-        # else
         return mask_ROI
             
 
@@ -357,4 +1044,13 @@ def import_US_RTS(folder,dcm_slice_ALL,dcm_SliceLoc,SIZE_Z,ROIs,im_size = (512,5
 # Run the script
 # ========================
 if __name__ == '__main__':
-    main(path_origin, path_target, delete_origin_data = False)
\ No newline at end of file
+    bbox_options = {"mode": bbox_mode, "merge_overlapping": merge_overlapping_bboxes}
+    if target_spacing is not None: # Crops resampled to the spacing set in Nifti_cropping.py
+        bbox_options.update(spacing = list(target_spacing), label_resampling = label_resampling)
+    main(path_origin, path_target, delete_origin_data = False, workers = n_workers,
+         output_mode = output_mode, compression_level = compression_level,
+         crop = crop_during_conversion, write_uncropped = write_uncropped,
+         bbox_options = bbox_options,
+         report_path = report_path, export_pickles = export_slice_pickles, pipeline_depth = pipeline_depth,
+         share_geometry = share_patient_geometry, write_4d = write_4d,
+         memory_budget_mb = memory_budget_mb, scratch_dir = scratch_dir)
\ No newline at end of file
@@ -2,83 +2,341 @@ import os
 import shutil
 import nibabel as nib
 import numpy as np
-from glob import glob
+from glob import glob, escape
 import copy
-from scipy.ndimage import label as connected_components
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.ndimage import label as connected_components, find_objects, affine_transform
+from scipy.sparse.csgraph import connected_components as graph_components
+from nifti_writer import save_nifti, file_ending, strip_ending
+from instrumentation import StageLog, RunReport, stage, file_bytes
+from slice_metadata import SliceMetadataStore, METADATA_NAME
+from fingerprint import case_fingerprint, write_fingerprint, FINGERPRINT_NAME
+try:
+    import fcntl # Reflinks (copy-on-write clones) on Linux
+except ImportError:
+    fcntl = None
 
 SRC_DIR = "C:\\nnUnet\\nnUnet_raw\\Dataset801_SBRTest"#Dataset801_SBRTest" # <-- CHANGE THIS to desired source directory
 fresh_dir = True # <-- CHANGE THIS to overwrite the output directory, if it exists already
+output_mode = "gzip" # <-- CHANGE THIS to "pgzip" (multi-threaded .nii.gz) or "nii" (uncompressed, for scratch datasets)
+compression_level = 1 # <-- CHANGE THIS to trade speed (1) for size (9)
+bbox_mode = "z" # <-- CHANGE THIS to "3d" to also crop in x and y around each structure
+merge_overlapping_bboxes = False # <-- CHANGE THIS to merge overlapping crops of nearby structures into one
+n_workers = 1 # <-- CHANGE THIS to crop cases in a pool of that many processes (1 = no process pool)
+link_files = True # <-- CHANGE THIS to False to always copy the sidecar files (sliceLOC, dataset.json...) instead of linking them
+target_spacing = None # <-- CHANGE THIS to an (x, y, z) spacing in mm, e.g. (1, 1, 2), to resample the crops (None = keep the scan spacing)
+label_resampling = "linear" # <-- CHANGE THIS to "nearest" for nearest-neighbour labels ("linear": label-aware, each label interpolated)
+report_path = None # <-- CHANGE THIS to a .jsonl path to record the time, bytes and memory of each stage of each case (see instrumentation.py)
 
 ## SEE MAIN AT THE BOTTOM
 
-def get_bboxes(mask_img, margin=10):
-    """Return list of bounding boxes around connected structures in a binary mask."""
-    mask = mask_img.get_fdata()
+def merge_bboxes(bboxes):
+    """Merge bounding boxes that overlap (in every dimension) into their common bounding box, until none overlap."""
+    starts = np.array([[s.start for s in bbox] for bbox in bboxes])
+    stops = np.array([[s.stop for s in bbox] for bbox in bboxes])
+    while True:
+        overlap = np.all((starts[:, None] < stops[None]) & (starts[None] < stops[:, None]), axis=2)
+        n_groups, group = graph_components(overlap, directed=False)
+        if n_groups == len(starts):
+            break
+        # A merged box can overlap boxes that none of its parts overlapped: repeat until stable
+        starts = np.array([starts[group == g].min(axis=0) for g in range(n_groups)])
+        stops = np.array([stops[group == g].max(axis=0) for g in range(n_groups)])
+    order = np.lexsort(starts.T)
+    return [tuple(slice(int(a), int(b)) for a, b in zip(starts[i], stops[i])) for i in order]
+
+def get_bboxes(mask_img, margin=10, mode="z", merge_overlapping=False):
+    """Return list of bounding boxes around connected structures in a binary mask (image or array).
+    mode = "z": full axial slices, constrained along z only. mode = "3d": box constrained in all 3 dimensions.
+    merge_overlapping = True merges overlapping boxes, so that nearby structures don't give overlapping crops.
+    """
+    mask = mask_img if isinstance(mask_img, np.ndarray) else np.asanyarray(mask_img.dataobj)
+    mask = mask.astype(np.uint8, copy=False)
 
     labeled_mask, num_features = connected_components(mask)
 
+    # Extent of every structure, from a single pass over the labeled mask
     bboxes = []
-    for i in range(1, num_features + 1):
-        structure_mask = (labeled_mask == i)
-        coords = np.argwhere(structure_mask)
-
-        if coords.size == 0:
+    for i, extent in enumerate(find_objects(labeled_mask), start=1):
+        if extent is None:
             continue
-        
-        # CODE FOR 3D-CONSTRAINED BOUNDING BOX 
-        # min_coords = np.maximum(coords.min(axis=0) - margin, 0)
-        # max_coords = np.minimum(coords.max(axis=0) + margin + 1, mask.shape)
-        # bbox = tuple(slice(min_c, max_c) for min_c, max_c in zip(min_coords, max_coords))
-
-        # CODE FOR 1D-CONSTRAINED BOUNDING BOX
-        zmin = np.maximum(coords[:, 2].min() - margin, 0)
-        zmax = np.minimum(coords[:, 2].max() + margin + 1, mask.shape[2])
-        bbox = (slice(0, mask.shape[0]), slice(0, mask.shape[1]), slice(zmin, zmax))
+
+        if mode == "3d": # 3D-CONSTRAINED BOUNDING BOX
+            bbox = tuple(slice(max(s.start - margin, 0), min(s.stop + margin, n)) for s, n in zip(extent, mask.shape))
+        elif mode == "z": # 1D-CONSTRAINED BOUNDING BOX
+            zmin = max(extent[2].start - margin, 0)
+            zmax = min(extent[2].stop + margin, mask.shape[2])
+            bbox = (slice(0, mask.shape[0]), slice(0, mask.shape[1]), slice(zmin, zmax))
+        else:
+            raise ValueError(f"Unknown bounding box mode '{mode}', expected 'z' or '3d'")
         
         bboxes.append(bbox)
         print(f"    -> Structure {i}: bbox shape = {[s.stop - s.start for s in bbox]}")
 
+    if merge_overlapping and len(bboxes) > 1:
+        bboxes = merge_bboxes(bboxes)
+        print(f"    -> {len(bboxes)} bbox(es) after merging overlapping ones")
+
     return bboxes
 
-def crop_and_save(ct_path, mask_path, ct_out, label_out):
-    """Crop CT and mask images around the mask ROI using memory-efficient nibabel slicer and save to output_dir."""
-    ct_img = nib.load(ct_path)
-    mask_img = nib.load(mask_path)
+def unscaled_data(img):
+    """Stored (unscaled) data of an image and its scl_slope/scl_inter, for images loaded from disk or built in memory."""
+    if nib.is_proxy(img.dataobj):
+        return np.asanyarray(img.dataobj.get_unscaled()), img.dataobj.slope, img.dataobj.inter
+    return np.asanyarray(img.dataobj), *img.header.get_slope_inter()
+
+def crop_image(img, raw_data, bbox, slope=None, inter=None):
+    """Crop an image to bbox from its unscaled (on-disk) data, keeping its dtype and scl_slope/scl_inter.
+    (nibabel's slicer returns scaled floats, which get requantized with a new scaling on save.)"""
+    cropped = nib.Nifti1Image(raw_data[bbox], img.slicer.slice_affine(bbox), img.header)
+    cropped.header.set_slope_inter(slope, inter)
+    return cropped
+
+def resampled_shape(shape, zooms, spacing):
+    """Shape of a volume resampled from zooms to spacing. The first voxel keeps its center, the grid stops at the last input voxel."""
+    return tuple(int(np.floor((n - 1) * z / s + 1e-6)) + 1 for n, z, s in zip(shape, zooms, spacing))
 
-    bboxes = get_bboxes(mask_img)
+def resample_volume(raw, zooms, spacing, order=3, shape=None):
+    """Resample a volume from zooms to spacing in one pass (diagonal scipy.ndimage.affine_transform): output voxel i
+    is at input voxel i * spacing / zooms. Integer data is rounded and clipped back to its dtype."""
+    scale = np.asarray(spacing, dtype=float) / np.asarray(zooms, dtype=float)
+    shape = shape or resampled_shape(raw.shape, zooms, spacing)
+    resampled = affine_transform(raw.astype(np.float32), scale, output_shape=shape, order=order, mode="nearest")
+    if np.issubdtype(raw.dtype, np.integer):
+        resampled = np.clip(np.rint(resampled), np.iinfo(raw.dtype).min, np.iinfo(raw.dtype).max)
+    return resampled.astype(raw.dtype)
+
+def resample_labels(raw, zooms, spacing, mode="linear", shape=None):
+    """Resample a label volume. mode = "nearest": nearest neighbour. mode = "linear" (label-aware): every label
+    (background included) is interpolated as a 0/1 volume and each voxel takes the label with the highest value."""
+    if mode == "nearest":
+        return resample_volume(raw, zooms, spacing, order=0, shape=shape)
+    if mode != "linear":
+        raise ValueError(f"Unknown label resampling '{mode}', expected 'linear' or 'nearest'")
+    scale = np.asarray(spacing, dtype=float) / np.asarray(zooms, dtype=float)
+    shape = shape or resampled_shape(raw.shape, zooms, spacing)
+    resampled, best = None, None
+    for value in np.unique(raw):
+        weight = affine_transform((raw == value).astype(np.float32), scale, output_shape=shape, order=1, mode="nearest")
+        if resampled is None:
+            resampled, best = np.full(shape, value, dtype=raw.dtype), weight
+        else:
+            resampled[weight > best] = value
+            np.maximum(best, weight, out=best)
+    return resampled
+
+def restore_crop(img, crop, mode="nearest"):
+    """Map an image on the grid of a resampled crop (e.g. a prediction) back to the crop's original grid.
+    `crop` is SliceMetadataStore.get_crop(crop_id); its bounding box then places the result in the full volume."""
+    resampled = crop["resampled"]
+    data = resample_labels(np.asanyarray(img.dataobj), resampled["spacing"], resampled["original_spacing"], mode,
+                           shape=tuple(resampled["original_shape"]))
+    return nib.Nifti1Image(data, np.array(resampled["original_affine"]), img.header)
+
+def crop_images(ct_img, mask_img, base_name, ct_out, label_out, nifti_options=None, bbox_options=None, metadata=None, log=None):
+    """Crop a CT and its mask around the mask ROIs and save the crops as <base_name>_<i:04> in ct_out / label_out.
+    The images can come from disk (crop_and_save) or straight from memory (MUHC_nnUnet_conversion.py).
+    Returns the list of written paths (empty if the mask has no structure). Crops of base_name left by an earlier run
+    that are not written again (e.g. a structure was removed) are deleted.
+    The bounding box of each crop in the full volume and its fingerprint statistics (fingerprint.py) are recorded in the
+    slice metadata store at `metadata`, if given.
+    bbox_options are passed to get_bboxes, except "spacing" and "label_resampling": with a spacing, every crop is
+    resampled to it (CT: cubic, labels: resample_labels) and its original geometry is recorded in the store.
+    log (instrumentation.StageLog) records the time, bytes and memory of each stage."""
+    nifti_options = nifti_options or {}
+    ending = file_ending(nifti_options.get("mode", "gzip"))
+    bbox_options = dict(bbox_options or {})
+    spacing = bbox_options.pop("spacing", None)
+    label_mode = bbox_options.pop("label_resampling", "linear")
+
+    with stage(log, "crop_bboxes") as record:
+        mask_raw, mask_slope, mask_inter = unscaled_data(mask_img)
+        bboxes = get_bboxes(mask_raw, **bbox_options)
+        if log and mask_img.get_filename():
+            record["bytes_read"] = file_bytes([mask_img.get_filename()])
     if not bboxes:
-        print(f"No structures found in mask: {mask_path}")
-        return
+        print(f"No structures found in mask: {base_name}")
+        remove_stale_crops(base_name, ct_out, label_out, [])
+        if metadata is not None:
+            with SliceMetadataStore(metadata) as store:
+                store.put_crops(base_name, {})
+        return []
 
-    for i, bbox in enumerate(bboxes):
-        if len(bbox) != 3:
-            print(f" >> Skipping bbox {i} from {mask_path} because it has {len(bbox)} dimensions instead of the required 3.")
-            continue
+    with stage(log, "crop_load_ct") as record:
+        ct_raw, ct_slope, ct_inter = unscaled_data(ct_img)
+        if log and ct_img.get_filename():
+            record["bytes_read"] = file_bytes([ct_img.get_filename()])
+    zooms = ct_img.header.get_zooms()[:3]
+    with stage(log, "crop_write", crops=len(bboxes), resampled=spacing is not None) as record:
+        written = []
+        crops = {}
+        resampled = {}
+        fingerprints = {}
+        for i, bbox in enumerate(bboxes):
+            if len(bbox) != 3:
+                print(f" >> Skipping bbox {i} from {base_name} because it has {len(bbox)} dimensions instead of the required 3.")
+                continue
 
-        # Use slicer for memory-efficient cropping
-        cropped_ct = ct_img.slicer[bbox[0], bbox[1], bbox[2]]
-        cropped_mask = mask_img.slicer[bbox[0], bbox[1], bbox[2]]
+            cropped_ct = crop_image(ct_img, ct_raw, bbox, ct_slope, ct_inter)
+            cropped_mask = crop_image(mask_img, mask_raw, bbox, mask_slope, mask_inter)
+            if spacing is not None:
+                cropped_ct, cropped_mask, resampled[f"{base_name}_{i:04}"] = resample_crop(cropped_ct, cropped_mask, zooms, spacing, label_mode)
 
-        ct_base_name = os.path.basename(ct_path).replace("_0000.nii.gz", "")
+            ct_out_path = os.path.join(ct_out, f"{base_name}_{i:04}{ending}")
+            mask_out_path = os.path.join(label_out, f"{base_name}_{i:04}{ending}")
 
-        ct_out_path = os.path.join(ct_out, f"{ct_base_name}_{i:04}.nii.gz")
-        mask_out_path = os.path.join(label_out, f"{ct_base_name}_{i:04}.nii.gz")
+            save_nifti(cropped_ct, ct_out_path, **nifti_options)
+            save_nifti(cropped_mask, mask_out_path, **nifti_options)
+            written += [ct_out_path, mask_out_path]
+            crops[f"{base_name}_{i:04}"] = bbox
+            if metadata is not None: # Statistics of the crop as written
+                fingerprints[f"{base_name}_{i:04}"] = case_fingerprint(np.asanyarray(cropped_ct.dataobj), ct_slope, ct_inter,
+                                                                        np.asanyarray(cropped_mask.dataobj), cropped_ct.header.get_zooms()[:3])
+        if log:
+            record["bytes_written"] = file_bytes(written)
+    remove_stale_crops(base_name, ct_out, label_out, written)
+    if metadata is not None:
+        with SliceMetadataStore(metadata) as store:
+            store.put_crops(base_name, crops, resampled)
+            for crop_id, fingerprint in fingerprints.items():
+                store.put_fingerprint(crop_id, fingerprint)
+    return written
 
-        nib.save(cropped_ct, ct_out_path)
-        nib.save(cropped_mask, mask_out_path)
+def remove_stale_crops(base_name, ct_out, label_out, written):
+    """Delete the crop files of base_name (<base_name>_<i:04>, any file ending) in ct_out / label_out that are not in written"""
+    written = {os.path.normpath(p) for p in written}
+    for folder in (ct_out, label_out):
+        for path in glob(os.path.join(escape(folder), escape(base_name) + "_[0-9][0-9][0-9][0-9].nii*")):
+            if strip_ending(path) != path and os.path.normpath(path) not in written:
+                os.remove(path)
 
+def resample_crop(cropped_ct, cropped_mask, zooms, spacing, label_mode="linear"):
+    """Resample a cropped CT and mask to spacing, keeping the stored dtype and scaling of the CT.
+    Returns the resampled images and their original geometry (for SliceMetadataStore.put_crops)."""
+    ct_raw = np.asanyarray(cropped_ct.dataobj)
+    affine = cropped_ct.affine @ np.diag(list(np.asarray(spacing, dtype=float) / np.asarray(zooms, dtype=float)) + [1])
+    ct = nib.Nifti1Image(resample_volume(ct_raw, zooms, spacing), affine, cropped_ct.header)
+    ct.header.set_slope_inter(*cropped_ct.header.get_slope_inter())
+    mask = nib.Nifti1Image(resample_labels(np.asanyarray(cropped_mask.dataobj), zooms, spacing, label_mode), affine, cropped_mask.header)
+    mask.header.set_slope_inter(*cropped_mask.header.get_slope_inter())
+    geometry = {"spacing": [float(s) for s in spacing], "shape": list(ct.shape), "original_spacing": [float(z) for z in zooms],
+                "original_shape": list(ct_raw.shape), "original_affine": cropped_ct.affine.tolist()}
+    return ct, mask, geometry
 
-def crop_cts(ct_dir, label_dir, ct_out, label_out):
-    ct_paths = sorted(glob(os.path.join(ct_dir, "*.nii.gz")))
-    label_paths = sorted(glob(os.path.join(label_dir, "*.nii.gz")))
+def crop_and_save(ct_path, mask_path, ct_out, label_out, nifti_options=None, bbox_options=None, metadata=None, log=None):
+    """Crop CT and mask images around the mask ROI and save to output_dir.
+    Volumes are read once (a .nii.gz has to be fully inflated anyway) and every bbox is cropped from memory.
+    nifti_options are passed to nifti_writer.save_nifti (output mode, compression level and threads),
+    bbox_options to get_bboxes (margin, mode, merge_overlapping) and to the resampling of the crops (spacing,
+    label_resampling, see crop_images), metadata is the slice metadata store of the crops."""
+    ct_base_name = strip_ending(os.path.basename(ct_path))
+    if ct_base_name.endswith("_0000"):
+        ct_base_name = ct_base_name[:-len("_0000")]
+    return crop_images(nib.load(ct_path), nib.load(mask_path), ct_base_name, ct_out, label_out, nifti_options, bbox_options, metadata, log)
 
-    for ct_path, label_path in zip(ct_paths, label_paths):
-        print(f"\nCropping scan: {os.path.basename(ct_path)}")
-        crop_and_save(ct_path, label_path, ct_out, label_out)
 
+def case_id(path):
+    """Case identifier of an image or label file: file name without its ending and _0000 channel suffix."""
+    name = strip_ending(os.path.basename(path))
+    return name[:-len("_0000")] if name.endswith("_0000") else name
 
-def copy_dir_wo_files(src, dst, exclude_file_dirs):
-    """Copy directory tree from src to dst, excluding files in certain subdirectories."""
+def pair_cases(ct_dir, label_dir):
+    """Pair the images and labels of two folders by case identifier.
+    Returns {case: (ct_path, label_path)} and the sorted lists of unpaired images and labels."""
+    ct_paths = {case_id(p): p for p in glob(os.path.join(ct_dir, "*.nii.gz")) + glob(os.path.join(ct_dir, "*.nii"))}
+    label_paths = {case_id(p): p for p in glob(os.path.join(label_dir, "*.nii.gz")) + glob(os.path.join(label_dir, "*.nii"))}
+    pairs = {case: (ct_paths[case], label_paths[case]) for case in sorted(ct_paths.keys() & label_paths.keys())}
+    unpaired_cts = sorted(ct_paths[case] for case in ct_paths.keys() - label_paths.keys())
+    unpaired_labels = sorted(label_paths[case] for case in label_paths.keys() - ct_paths.keys())
+    return pairs, unpaired_cts, unpaired_labels
+
+def crop_case(ct_path, label_path, ct_out, label_out, nifti_options=None, bbox_options=None, metadata=None, instrument=False):
+    """crop_and_save for one case, returning the number of crops, the time it took and the stage records of the
+    case if instrument is True."""
+    log = StageLog(case_id(ct_path)) if instrument else None
+    start = time.perf_counter()
+    written = crop_and_save(ct_path, label_path, ct_out, label_out, nifti_options, bbox_options, metadata, log)
+    return len(written) // 2, time.perf_counter() - start, log.records if log else []
+
+def crop_cts(ct_dir, label_dir, ct_out, label_out, nifti_options=None, bbox_options=None, workers=1, report=None, metadata=None):
+    """Crop every case of an images / labels folder pair, in a pool of `workers` processes if workers > 1.
+    Images and labels are paired by case identifier; files without a counterpart are reported and skipped.
+    The crop bounding boxes are recorded in the slice metadata store at `metadata`, if given.
+    The stage records of each case are added to report (instrumentation.RunReport), if given."""
+    pairs, unpaired_cts, unpaired_labels = pair_cases(ct_dir, label_dir)
+    for path in unpaired_cts:
+        print(f"WARNING: No label for image {path}. Skipping...")
+    for path in unpaired_labels:
+        print(f"WARNING: No image for label {path}. Skipping...")
+
+    nifti_options = dict(nifti_options or {})
+    if workers > 1: # Compression threads are shared between the worker processes
+        nifti_options.setdefault("threads", max(1, (os.cpu_count() or 1) // workers))
+
+    start = time.perf_counter()
+    n_crops, failed = 0, []
+    def case_done(case, result):
+        nonlocal n_crops
+        n, seconds, records = result
+        n_crops += n
+        if report:
+            report.add(records)
+        print(f"Cropped scan: {case} ({n} crops, {seconds:.1f} s)")
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(crop_case, *paths, ct_out, label_out, nifti_options, bbox_options, metadata, report is not None): case for case, paths in pairs.items()}
+            for future in as_completed(futures):
+                try:
+                    case_done(futures[future], future.result())
+                except Exception as e:
+                    print(f"Error while cropping {futures[future]}: {e!r}")
+                    failed.append(futures[future])
+    else:
+        for case, paths in pairs.items():
+            print(f"\nCropping scan: {case}")
+            try:
+                case_done(case, crop_case(*paths, ct_out, label_out, nifti_options, bbox_options, metadata, report is not None))
+            except Exception as e:
+                print(f"Error while cropping {case}: {e!r}")
+                failed.append(case)
+
+    elapsed = time.perf_counter() - start
+    print(f"\n> {ct_dir}: {len(pairs) - len(failed)}/{len(pairs)} cases cropped into {n_crops} crops in {elapsed:.1f} s"
+          f" ({elapsed / max(len(pairs), 1):.2f} s/case), {len(unpaired_cts) + len(unpaired_labels)} unpaired files")
+    if failed:
+        print(f"> Failed cases: {', '.join(sorted(failed))}")
+
+
+FICLONE = 0x40049409 # Linux ioctl cloning a whole file (btrfs, XFS...)
+
+def clone_file(src_file, dst_file, link=True):
+    """Clone src_file to dst_file: a reflink where the filesystem supports it, else a hard link when both are on
+    the same filesystem, else a copy. Returns the method used ("reflink", "hardlink" or "copy")."""
+    if link:
+        if fcntl is not None:
+            try:
+                with open(src_file, "rb") as fs, open(dst_file, "wb") as fd:
+                    fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+                shutil.copystat(src_file, dst_file)
+                return "reflink"
+            except OSError:
+                os.remove(dst_file)
+        try:
+            os.link(src_file, dst_file)
+            return "hardlink"
+        except OSError: # Other filesystem, or no hard link support
+            pass
+    shutil.copy2(src_file, dst_file)
+    return "copy"
+
+def copy_dir_wo_files(src, dst, exclude_file_dirs, link=True):
+    """Copy directory tree from src to dst, excluding files in certain subdirectories.
+    Files are linked when possible (see clone_file) and files whose size and mtime already match are skipped.
+    Linked files share their data with src: rewrite them atomically (new file + os.replace), not in place."""
+    counts = {"reflink": 0, "hardlink": 0, "copy": 0, "unchanged": 0}
     for root, _, files in os.walk(src):
         # Determine the relative path from the source root
         rel_path = os.path.relpath(root, src)
@@ -93,9 +351,33 @@ def copy_dir_wo_files(src, dst, exclude_file_dirs):
 
         # Copy all files in this directory
         for file in files:
+            if rel_path == "." and file == FINGERPRINT_NAME: # Statistics of the uncropped volumes, rewritten for the crops
+                continue
             src_file = os.path.join(root, file)
             dst_file = os.path.join(dest_dir, file)
-            shutil.copy2(src_file, dst_file)
+            if os.path.exists(dst_file):
+                src_stat, dst_stat = os.stat(src_file), os.stat(dst_file)
+                if src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+                    counts["unchanged"] += 1
+                    continue
+                os.remove(dst_file)
+            # The slice metadata store is modified in place by the cropping: never shared with the source
+            counts[clone_file(src_file, dst_file, link and file != METADATA_NAME)] += 1
+    print("> Dataset files: " + ", ".join(f"{n} {method}" for method, n in counts.items()))
+
+def set_file_ending(dataset_dir, ending):
+    """Make the file_ending of a dataset.json follow the output mode of the files written in the dataset."""
+    json_path = os.path.join(dataset_dir, "dataset.json")
+    if not os.path.exists(json_path):
+        return
+    with open(json_path, "r") as f:
+        dataset_json = json.load(f)
+    if dataset_json.get("file_ending") != ending:
+        dataset_json["file_ending"] = ending
+        # New file, so that a dataset.json linked to the source dataset's is not modified in place
+        with open(json_path + ".tmp", "w") as f:
+            json.dump(dataset_json, f, indent=1)
+        os.replace(json_path + ".tmp", json_path)
 
 if __name__ == "__main__":
 
@@ -104,11 +386,16 @@ if __name__ == "__main__":
     crop_dir = SRC_DIR + "CROPPED"
     exclude_file_dirs = {"imagesTr", "labelsTr", "imagesTs", "labelsTs"}
 
-    if not os.path.exists(crop_dir):
-        copy_dir_wo_files(SRC_DIR, crop_dir, exclude_file_dirs)
-    elif fresh_dir:
-        shutil.rmtree(crop_dir)
-        copy_dir_wo_files(SRC_DIR, crop_dir, exclude_file_dirs)
+    if fresh_dir: # Only the crops are removed, unchanged dataset files are kept
+        for d in exclude_file_dirs:
+            if os.path.exists(os.path.join(crop_dir, d)):
+                shutil.rmtree(os.path.join(crop_dir, d))
+    copy_dir_wo_files(SRC_DIR, crop_dir, exclude_file_dirs, link=link_files)
+    nifti_options = {"mode": output_mode, "level": compression_level}
+    bbox_options = {"mode": bbox_mode, "merge_overlapping": merge_overlapping_bboxes}
+    if target_spacing is not None:
+        bbox_options.update(spacing=list(target_spacing), label_resampling=label_resampling)
+    set_file_ending(crop_dir, file_ending(output_mode))
 
     imagesTr_dir = os.path.join(SRC_DIR, "imagesTr")
     labelsTr_dir = os.path.join(SRC_DIR, "labelsTr")
@@ -120,7 +407,15 @@ if __name__ == "__main__":
     its_out = os.path.join(crop_dir, "imagesTs")
     lts_out = os.path.join(crop_dir, "labelsTs")
 
-    crop_cts(imagesTr_dir, labelsTr_dir, itr_out, ltr_out)
-    crop_cts(imagesTs_dir, labelsTs_dir, its_out, lts_out)
+    # Crop bounding boxes go to the slice metadata store copied from the source dataset
+    metadata = os.path.join(crop_dir, METADATA_NAME) if os.path.exists(os.path.join(crop_dir, METADATA_NAME)) else None
+    report = RunReport(report_path, dataset=SRC_DIR, workers=n_workers, output_mode=output_mode, bbox_mode=bbox_mode) if report_path else None
+    crop_cts(imagesTr_dir, labelsTr_dir, itr_out, ltr_out, nifti_options, bbox_options, workers=n_workers, report=report, metadata=metadata)
+    crop_cts(imagesTs_dir, labelsTs_dir, its_out, lts_out, nifti_options, bbox_options, workers=n_workers, report=report, metadata=metadata)
+    if report:
+        report.close()
+    if metadata is not None:
+        with SliceMetadataStore(metadata) as store:
+            write_fingerprint(crop_dir, store, cropped=True)
 
     print(f"\n{'-'*5} Cropping script completed {'-'*5}")
\ No newline at end of file
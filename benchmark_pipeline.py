@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the conversion (MUHC_nnUnet_conversion.py) and cropping (Nifti_cropping.py) pipeline on synthetic data.
+
+Synthetic patients are written with pydicom in the layout expected by the conversion script:
+Work_folder
+├── PatID1
+│ ├── GTV.txt
+│ ├── CT_0
+│ │ ├── RS_synthetic.dcm
+│ │ ├── CT[...slice...].dcm
+│ ├── CT_50
+[...]
+
+Every stage is then timed (import_US_stack, import_US_RTS, main() and crop_cts) and the results (time, slices/s,
+MB/s, pixel decodes, peak RSS) are written to a JSON file, so that runs of different commits can be compared.
+No patient data is needed.
+"""
+
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import nibabel as nib
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, CTImageStorage, RTStructureSetStorage
+try:
+    import resource # Peak RSS on Linux / macOS
+except ImportError:
+    resource = None
+try:
+    import cv2 # Optional: fill_polygons is checked against cv2.fillPoly
+except ImportError:
+    cv2 = None
+
+# Synthetic dataset
+n_patients = 4  # <-- CHANGE THIS as needed
+phases = (0, 50)  # <-- CHANGE THIS as needed (one CT_<phase> folder per phase)
+n_slices = 120  # <-- CHANGE THIS as needed (slices per phase, including empty slices at both ends)
+matrix_size = 512  # <-- CHANGE THIS as needed
+slice_thickness = 2.5  # <-- CHANGE THIS as needed (mm)
+rois = ("GTV1", "GTV2")  # <-- CHANGE THIS as needed (ROI names, written to GTV.txt)
+contour_points = 128  # <-- CHANGE THIS as needed (points per contour)
+
+# Pipeline settings
+n_workers = 1  # <-- CHANGE THIS as needed (main() and crop_cts)
+output_mode = "gzip"  # <-- CHANGE THIS as needed (see nifti_writer.OUTPUT_MODES)
+compression_level = 1  # <-- CHANGE THIS as needed
+
+work_dir = None  # <-- CHANGE THIS to keep the synthetic data in a given folder (None: temporary folder, deleted at the end)
+results_path = "benchmark_results.json"  # <-- CHANGE THIS as needed
+quiet = True  # <-- CHANGE THIS to False to see the output of the pipeline
+
+
+# ===========================
+# Synthetic data
+# ===========================
+def new_dataset(sop_class, sop_uid):
+    """Dataset with file meta and the patient / study attributes shared by the CT and RTStruct files"""
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = sop_class
+    ds.file_meta.MediaStorageSOPInstanceUID = sop_uid
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = sop_uid
+    ds.PatientName = ds.PatientID = "SYNTHETIC"
+    ds.StudyDate, ds.StudyTime = "20240101", "120000"
+    return ds
+
+def write_ct_series(folder, n, size, thickness, rng):
+    """Write a CT series of n int16 slices (body ellipse, empty slices at both ends) in random file order.
+    Returns the (SOPInstanceUID, z) of each slice, sorted by z, and the series UIDs."""
+    study, series, frame = generate_uid(), generate_uid(), generate_uid()
+    yy, xx = np.mgrid[:size, :size]
+    body = ((yy - size / 2) / (size * 0.45))**2 + ((xx - size / 2) / (size * 0.35))**2 < 1
+    slices = []
+    for k in rng.permutation(n):
+        z = -n * thickness / 2 + k * thickness
+        ds = new_dataset(CTImageStorage, generate_uid())
+        ds.Modality = "CT"
+        ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.FrameOfReferenceUID = study, series, frame
+        ds.ImagePositionPatient = [-250.0, -250.0, z]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [500 / size, 500 / size]
+        ds.SliceThickness = thickness
+        ds.SliceLocation = z
+        ds.InstanceNumber = int(k) + 1
+        ds.Rows = ds.Columns = size
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 1
+        ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+        pixels = np.zeros((size, size), dtype=np.int16)
+        if 3 <= k < n - 3:
+            pixels[body] = rng.integers(900, 1200, int(body.sum()))
+        ds.PixelData = pixels.tobytes()
+        pydicom.dcmwrite(os.path.join(folder, f"CT{ds.SOPInstanceUID}.dcm"), ds, enforce_file_format=True)
+        slices.append((ds.SOPInstanceUID, z))
+    return sorted(slices, key=lambda s: s[1]), (study, series, frame)
+
+def write_rtstruct(folder, slices, uids, roi_names, n_points):
+    """Write an RTStruct with one sphere-like structure per ROI, contoured on the slices it crosses"""
+    study, series, frame = uids
+    ds = new_dataset(RTStructureSetStorage, generate_uid())
+    ds.Modality = "RTSTRUCT"
+    ds.StudyInstanceUID, ds.SeriesInstanceUID = study, generate_uid()
+    ds.StructureSetLabel = "SYNTHETIC"
+    ds.StructureSetROISequence, ds.ROIContourSequence = [], []
+    angles = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+    n = len(slices)
+    for i, name in enumerate(roi_names):
+        roi = Dataset()
+        roi.ROINumber, roi.ROIName, roi.ReferencedFrameOfReferenceUID = i + 1, name, frame
+        ds.StructureSetROISequence.append(roi)
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = i + 1
+        roi_contour.ContourSequence = []
+        center_k, half_height = n // 2 + 10 * i - 5 * len(roi_names), 6
+        for k in range(max(center_k - half_height, 0), min(center_k + half_height + 1, n)):
+            radius = 30 * np.sqrt(max(1 - ((k - center_k) / (half_height + 1))**2, 0.1))
+            image = Dataset()
+            image.ReferencedSOPClassUID, image.ReferencedSOPInstanceUID = CTImageStorage, slices[k][0]
+            contour = Dataset()
+            contour.ContourImageSequence = [image]
+            contour.ContourGeometricType = "CLOSED_PLANAR"
+            contour.NumberOfContourPoints = n_points
+            points = np.stack([-60 + 70 * i + radius * np.cos(angles), radius * np.sin(angles), np.full(n_points, slices[k][1])], axis=1)
+            contour.ContourData = [f"{v:.3f}" for v in points.ravel()]
+            roi_contour.ContourSequence.append(contour)
+        ds.ROIContourSequence.append(roi_contour)
+    pydicom.dcmwrite(os.path.join(folder, "RS_synthetic.dcm"), ds, enforce_file_format=True)
+
+def make_dataset(path_origin, seed=0):
+    """Write the synthetic patients. Returns the list of phase folders."""
+    rng = np.random.default_rng(seed)
+    folders = []
+    for p in range(n_patients):
+        patient = os.path.join(path_origin, f"SYNTH{p:03}")
+        os.makedirs(patient, exist_ok=True)
+        with open(os.path.join(patient, "GTV.txt"), "w") as f:
+            f.write("\n".join(rois))
+        for phase in phases:
+            folder = os.path.join(patient, f"CT_{phase}") + "/"
+            os.makedirs(folder, exist_ok=True)
+            slices, uids = write_ct_series(folder, n_slices, matrix_size, slice_thickness, rng)
+            write_rtstruct(folder, slices, uids, rois, contour_points)
+            folders.append(folder)
+    return folders
+
+
+# ===========================
+# Measurements
+# ===========================
+decodes = 0
+def count_decodes():
+    """Count the pixel decodes of this process (Dataset.pixel_array accesses)"""
+    pixel_array = Dataset.pixel_array
+    def counted(self):
+        global decodes
+        decodes += 1
+        return pixel_array.fget(self)
+    Dataset.pixel_array = property(counted)
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its finished children (worker pools), in MB"""
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024 # ru_maxrss is in bytes on macOS, kB on Linux
+    return {who: resource.getrusage(getattr(resource, "RUSAGE_" + who.upper())).ru_maxrss * scale / 1e6 for who in ("self", "children")}
+
+def folder_bytes(paths):
+    """Total size of files and folders, in bytes"""
+    return sum(os.path.getsize(path) if os.path.isfile(path) else
+               sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files) for path in paths)
+
+def run_stage(results, name, func, slices, data_paths=()):
+    """Run func (quietly), recording its time, throughput and pixel decodes in results[name].
+    Throughput is measured on the size of data_paths (inputs, or outputs for the generate stage) after the run."""
+    start_decodes = decodes
+    with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+        start = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - start
+    n_bytes = folder_bytes(data_paths)
+    results[name] = {"seconds": seconds, "slices": slices, "slices_per_s": slices / seconds,
+                     "MB": n_bytes / 1e6, "MB_per_s": n_bytes / 1e6 / seconds, "pixel_decodes": decodes - start_decodes}
+    print(f"{name:<16} {seconds:8.2f} s {slices / seconds:9.1f} slices/s {n_bytes / 1e6 / seconds:8.1f} MB/s")
+    return value
+
+def check_fill_polygons(fill_polygons, n=1000, seed=0):
+    """Compare fill_polygons with cv2.fillPoly on random polygons inside a 64x64 slice (convex, star-shaped and
+    self-intersecting, 1 to 3 per slice). Returns the number of polygon sets and of pixels that differ."""
+    rng = np.random.default_rng(seed)
+    differing = pixels = 0
+    for t in range(n):
+        if t % 3 == 0: # Convex: points on an ellipse
+            k = rng.integers(3, 12)
+            a, r = np.sort(rng.uniform(0, 2 * np.pi, k)), rng.uniform(1, 31, 2)
+            polygons = [(np.round(32 + r[0] * np.cos(a)), np.round(32 + r[1] * np.sin(a)))]
+        elif t % 3 == 1: # Star-shaped
+            polygons = []
+            for _ in range(rng.integers(1, 4)):
+                k = rng.integers(3, 20)
+                a, r = np.sort(rng.uniform(0, 2 * np.pi, k)), rng.uniform(0, 31, k)
+                polygons.append((np.round(32 + r * np.cos(a)), np.round(32 + r * np.sin(a))))
+        else: # Random vertices
+            k = rng.integers(3, 15)
+            polygons = [(rng.integers(0, 64, k), rng.integers(0, 64, k))]
+        polygons = [(c.astype(int), r.astype(int)) for c, r in polygons]
+        mask = np.zeros((64, 64), dtype=bool)
+        fill_polygons(mask, polygons)
+        reference = np.zeros((64, 64), dtype=np.uint8)
+        cv2.fillPoly(reference, [np.stack([c, r], axis=1).astype(np.int32) for c, r in polygons], 1)
+        d = np.count_nonzero(mask != reference.astype(bool))
+        differing += d > 0
+        pixels += d
+    return {"cv2": cv2.__version__, "polygon_sets": n, "differing": int(differing), "pixels": int(pixels)}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# ===========================
+# Benchmark
+# ===========================
+def main():
+    root = work_dir or tempfile.mkdtemp(prefix="nnunet_benchmark_")
+    path_origin = os.path.join(root, "DICOM") + "/"
+    os.environ["nnUNet_raw"] = os.path.join(root, "nnUNet_raw")
+
+    # The conversion script reads nnUNet_raw on import
+    import MUHC_nnUnet_conversion as conversion
+    import Nifti_cropping as cropping
+    count_decodes()
+
+    results = {"commit": git_commit(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": sys.version.split()[0],
+               "platform": platform.platform(), "cpu_count": os.cpu_count(),
+               "config": {"n_patients": n_patients, "phases": list(phases), "n_slices": n_slices, "matrix_size": matrix_size,
+                          "rois": list(rois), "contour_points": contour_points, "n_workers": n_workers,
+                          "output_mode": output_mode, "compression_level": compression_level},
+               "stages": {}}
+    stages = results["stages"]
+    n_total = n_patients * len(phases) * n_slices
+    try:
+        if os.path.exists(path_origin):
+            shutil.rmtree(path_origin)
+        folders = run_stage(stages, "generate", lambda: make_dataset(path_origin), n_total, [path_origin])
+
+        if cv2 is not None:
+            results["fill_polygons_vs_cv2"] = check_fill_polygons(conversion.fill_polygons)
+            print(f"> fill_polygons vs cv2.fillPoly: {results['fill_polygons_vs_cv2']}")
+
+        # Single phase stages, on the first phase folder
+        folder = folders[0]
+        stack = run_stage(stages, "import_US_stack", lambda: conversion.import_US_stack(folder, SIZE_Z=0, im_size=(matrix_size, matrix_size)),
+                          n_slices, [folder])
+        _, dcm_slice_ALL, dcm_SliceLoc, _, _, geometry = stack
+        run_stage(stages, "import_US_RTS", lambda: conversion.import_US_RTS(folder, dcm_slice_ALL, dcm_SliceLoc, SIZE_Z=0, ROIs=list(rois),
+                                                                           im_size=(matrix_size, matrix_size), geometry=geometry),
+                  len(dcm_SliceLoc), [folder + "RS_synthetic.dcm"])
+
+        # Full conversion and cropping
+        path_target = os.path.join(os.environ["nnUNet_raw"], "Dataset999_Benchmark") + "/"
+        if os.path.exists(path_target):
+            shutil.rmtree(path_target)
+        run_stage(stages, "main", lambda: conversion.main(path_origin, path_target, workers=n_workers, output_mode=output_mode,
+                                                         compression_level=compression_level), n_total, [path_origin])
+        crop_dir = path_target.rstrip("/") + "CROPPED"
+        if os.path.exists(crop_dir):
+            shutil.rmtree(crop_dir)
+        nifti_options = {"mode": output_mode, "level": compression_level}
+        def crop():
+            for split in ("Tr", "Ts"):
+                os.makedirs(os.path.join(crop_dir, "images" + split), exist_ok=True)
+                os.makedirs(os.path.join(crop_dir, "labels" + split), exist_ok=True)
+                cropping.crop_cts(path_target + "images" + split, path_target + "labels" + split, os.path.join(crop_dir, "images" + split),
+                                  os.path.join(crop_dir, "labels" + split), nifti_options, workers=n_workers)
+        n_converted = sum(nib.load(os.path.join(path_target + "images" + split, f)).shape[2]
+                          for split in ("Tr", "Ts") for f in os.listdir(path_target + "images" + split))
+        run_stage(stages, "crop_cts", crop, n_converted, [path_target + "imagesTr", path_target + "imagesTs",
+                                                         path_target + "labelsTr", path_target + "labelsTs"])
+        results["output_MB"] = {"converted": folder_bytes([path_target]) / 1e6, "cropped": folder_bytes([crop_dir]) / 1e6}
+    finally:
+        results["peak_rss_MB"] = peak_rss_mb()
+        if work_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"> Peak RSS (MB): {results['peak_rss_MB']}")
+    print(f"> Results written to {results_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+DICOM input sources for MUHC_nnUnet_conversion.py: a directory tree, a .zip or a .tar(.gz/.bz2/.xz) archive with
+the same layout (PatID/GTV.txt, PatID/<phase>/CT*.dcm, PatID/<phase>/RS*.dcm), read without extracting it.
+
+Folders are given relative to the source root ("PatID1/CT_0/"). Files are named by members: full paths for a
+directory, member names for an archive. In an archive, patients are the folders holding a GTV.txt (the export may
+be wrapped in a top-level folder) and everything is listed from the archive index.
+
+Members are streamed from the archive into pydicom: .zip and uncompressed .tar members are read in place. A
+compressed tar cannot seek backwards cheaply, so the members of a phase folder are read in archive order and kept
+in a buffer of at most buffer_mb (least recently used folders are dropped first). Sources can be sent to worker
+processes: each process reopens the archive, the index is sent along.
+
+prefetch(source, folder) reads all the files of a phase folder into memory ahead of its conversion (see the
+pipelined conversion in MUHC_nnUnet_conversion.py). The result is a source with the same member names.
+"""
+
+import fnmatch
+import glob
+import io
+import os
+import shutil
+import tarfile
+import time
+import zipfile
+from collections import OrderedDict
+
+buffer_mb = 512 # Member buffer of compressed tar archives
+
+
+def open_source(path, buffer_mb=buffer_mb):
+    """DirectorySource, ZipSource or TarSource of path ("" for full paths, as in import_US_stack(folder))"""
+    if path == "" or os.path.isdir(path):
+        return DirectorySource(path)
+    if zipfile.is_zipfile(path):
+        return ZipSource(path)
+    if tarfile.is_tarfile(path):
+        return TarSource(path, buffer_mb)
+    raise ValueError(f"DICOM source is not a directory, a .zip or a .tar archive: {path}")
+
+
+class DirectorySource:
+    """Patient folders of a directory (path_origin)"""
+    deletable = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, folder):
+        return os.path.join(self.root, folder) if self.root else folder
+
+    def patients(self):
+        return [Pa for Pa in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, Pa))]
+
+    def subfolders(self, folder):
+        return [P for P in os.listdir(self.path(folder)) if os.path.isdir(os.path.join(self.path(folder), P))]
+
+    def glob(self, folder, pattern):
+        return glob.glob(os.path.join(self.path(folder), pattern))
+
+    def files(self, folder):
+        """(name, size, mtime [ns], member) of the files of a folder, sorted by name"""
+        return [(e.name, e.stat().st_size, e.stat().st_mtime_ns, e.path)
+                for e in sorted(os.scandir(self.path(folder)), key=lambda e: e.name) if e.is_file()]
+
+    def size(self, member):
+        return os.path.getsize(member)
+
+    def open(self, member):
+        return open(member, "rb")
+
+    def read_text(self, folder, name):
+        with open(os.path.join(self.path(folder), name), "r") as f:
+            return f.read()
+
+    def delete(self, folder):
+        shutil.rmtree(self.path(folder))
+
+
+class _ArchiveSource:
+    """Index of an archive: folder -> {file name: (size, mtime [ns], member info)} and folder -> subfolders.
+    Patients and subfolders are listed in archive order (of their first member), so that a compressed tar is read
+    forward when they are converted in that order."""
+    deletable = False
+
+    def __init__(self, path):
+        self.root_path = path
+        self.folders = {}
+        self.subdirs = {}
+        for name, size, mtime, info in self._members():
+            folder, _, file = name.rpartition("/")
+            self.folders.setdefault(folder, {})[file] = (size, mtime, info)
+            while folder:
+                parent, _, child = folder.rpartition("/")
+                self.subdirs.setdefault(parent, {})[child] = None # Ordered set: archive order
+                folder = parent
+        # Patients are the folders with a GTV.txt, the root is their (most common) parent folder
+        parents = [f.rpartition("/")[0] for f, files in self.folders.items() if "GTV.txt" in files]
+        root = max(set(parents), key=parents.count) if parents else ""
+        self.prefix = root + "/" if root else ""
+        self.handle = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["handle"] = None
+        return state
+
+    def _folder(self, folder):
+        return (self.prefix + folder).strip("/")
+
+    def patients(self):
+        return [P for P in self.subdirs.get(self._folder(""), ()) if "GTV.txt" in self.folders.get(self._folder(P), {})]
+
+    def subfolders(self, folder):
+        return list(self.subdirs.get(self._folder(folder), ()))
+
+    def glob(self, folder, pattern):
+        folder = self._folder(folder)
+        return [folder + "/" + name for name in sorted(self.folders.get(folder, {})) if fnmatch.fnmatch(name, pattern)]
+
+    def files(self, folder):
+        folder = self._folder(folder)
+        return [(name, size, mtime, folder + "/" + name) for name, (size, mtime, _) in sorted(self.folders.get(folder, {}).items())]
+
+    def _info(self, member):
+        folder, _, name = member.rpartition("/")
+        return self.folders[folder][name]
+
+    def size(self, member):
+        return self._info(member)[0]
+
+    def read_text(self, folder, name):
+        with self.open(self._folder(folder) + "/" + name) as f:
+            return f.read().decode()
+
+
+class ZipSource(_ArchiveSource):
+    """Patient folders of a .zip archive, members are decompressed as pydicom reads them"""
+    def _members(self):
+        with zipfile.ZipFile(self.root_path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield info.filename.rstrip("/"), info.file_size, int(time.mktime(info.date_time + (0, 0, -1))) * 10**9, info.filename
+
+    def open(self, member):
+        if self.handle is None:
+            self.handle = zipfile.ZipFile(self.root_path)
+        return self.handle.open(self._info(member)[2])
+
+
+class TarSource(_ArchiveSource):
+    """Patient folders of a .tar archive, optionally compressed (gzip, bz2, xz)"""
+    def __init__(self, path, buffer_mb=buffer_mb):
+        self.buffer_bytes = buffer_mb * 10**6
+        self.buffer = OrderedDict() # folder -> {member: bytes}
+        try:
+            tarfile.open(path, "r:").close()
+            self.compressed = False
+        except tarfile.ReadError:
+            self.compressed = True
+        super().__init__(path)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["buffer"] = OrderedDict()
+        return state
+
+    def _members(self):
+        with tarfile.open(self.root_path, "r:*") as tf:
+            for info in tf:
+                if info.isfile():
+                    yield info.name[2:] if info.name.startswith("./") else info.name, info.size, int(info.mtime) * 10**9, info
+
+    def _tar(self):
+        if self.handle is None:
+            self.handle = tarfile.open(self.root_path, "r:*")
+        return self.handle
+
+    def open(self, member):
+        info = self._info(member)[2]
+        if not self.compressed:
+            return self._tar().extractfile(info)
+        folder = member.rpartition("/")[0]
+        if folder not in self.buffer:
+            self._fill(folder)
+        self.buffer.move_to_end(folder)
+        data = self.buffer[folder].get(member)
+        return io.BytesIO(data) if data is not None else self._tar().extractfile(info)
+
+    def _fill(self, folder):
+        """Read the members of a folder in archive order (forward reads only) into the buffer"""
+        members = sorted(((info.offset_data, folder + "/" + name, info) for name, (_, _, info) in self.folders[folder].items()),
+                         key=lambda m: m[0])
+        data, total = {}, 0
+        for _, member, info in members:
+            if total + info.size > self.buffer_bytes: # Larger than the buffer: the rest is read from the archive
+                break
+            data[member] = self._tar().extractfile(info).read()
+            total += info.size
+        while self.buffer and total + sum(len(b) for d in self.buffer.values() for b in d.values()) > self.buffer_bytes:
+            self.buffer.popitem(last=False)
+        self.buffer[folder] = data
+
+
+class PrefetchedFolder:
+    """Files of one folder of a source, read into memory. Members keep the names they have in the source."""
+    def __init__(self, source, folder):
+        self.folder = folder
+        self.data = {}
+        self.names = {}
+        for name, _, _, member in source.files(folder):
+            with source.open(member) as f:
+                self.data[member] = f.read()
+            self.names[member] = name
+
+    def nbytes(self):
+        return sum(len(b) for b in self.data.values())
+
+    def glob(self, folder, pattern):
+        return [member for member, name in self.names.items() if fnmatch.fnmatch(name, pattern)]
+
+    def size(self, member):
+        return len(self.data[member])
+
+    def open(self, member):
+        return io.BytesIO(self.data[member])
+
+
+def prefetch(source, folder):
+    """Source of the files of `folder`, read into memory"""
+    return PrefetchedFolder(source or open_source(""), folder)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Dataset fingerprint statistics collected while the volumes are in memory (conversion and cropping), so that they
+need no second pass over the images.
+
+Per case (case_fingerprint): shape, spacing, number of foreground voxels and a histogram of the foreground HU
+values (1 HU bins), with their count, sum, sum of squares, min and max. Per-case statistics are kept in the
+dataset's slice metadata store (slice_metadata.SliceMetadataStore), so that re-runs only update converted cases.
+
+Per dataset (dataset_fingerprint, written to fingerprint_stats.json): the merged histogram and the statistics
+nnU-Net's fingerprint extraction computes (foreground intensity mean, std, min, max, median and 0.5 / 99.5
+percentiles, shapes and spacings). The file holds aggregated statistics only, no per-voxel data.
+"""
+
+import json
+import os
+import nibabel as nib
+import numpy as np
+
+FINGERPRINT_NAME = "fingerprint_stats.json"
+HU_MIN = -2048 # Histogram range, values outside go to the edge bins
+HU_MAX = 8192
+
+
+def case_fingerprint(raw, slope, inter, mask, spacing, slab=16):
+    """Statistics of one case from its stored CT data (scaled with slope / inter) and its label volume.
+    Volumes are read `slab` slices (last axis) at a time, so disk-backed volumes (np.memmap) are not loaded whole."""
+    counts = np.zeros(HU_MAX - HU_MIN + 1, dtype=np.int64)
+    n, total, squares, low, high = 0, 0.0, 0.0, np.inf, -np.inf
+    for z in range(0, raw.shape[-1], slab):
+        values = raw[..., z:z + slab][mask[..., z:z + slab] > 0].astype(np.float64)
+        if not values.size:
+            continue
+        if slope is not None and not np.isnan(slope):
+            values = values * slope + (inter or 0)
+        n += values.size
+        total += values.sum()
+        squares += np.dot(values, values)
+        low, high = min(low, values.min()), max(high, values.max())
+        counts += np.bincount(np.clip(np.rint(values), HU_MIN, HU_MAX).astype(np.int64) - HU_MIN, minlength=len(counts))
+    fingerprint = {"shape": [int(s) for s in raw.shape], "spacing": [float(s) for s in spacing], "foreground_voxels": int(n),
+                   "sum": float(total), "sum_squares": float(squares),
+                   "min": float(low) if n else None, "max": float(high) if n else None,
+                   "histogram_start": 0, "histogram": np.zeros(0, dtype=np.int64)}
+    if n:
+        used = np.flatnonzero(counts)
+        fingerprint["histogram_start"] = int(HU_MIN + used[0])
+        fingerprint["histogram"] = counts[used[0]:used[-1] + 1]
+    return fingerprint
+
+
+def file_fingerprint(image_path, label_path):
+    """case_fingerprint of a case already written (image and label NIfTI files, e.g. converted before the statistics
+    were collected), from one read of each file"""
+    img, label = nib.load(image_path), nib.load(label_path)
+    return case_fingerprint(np.asanyarray(img.dataobj.get_unscaled()), img.dataobj.slope, img.dataobj.inter,
+                            np.asanyarray(label.dataobj), img.header.get_zooms()[:3])
+
+
+def histogram_percentiles(start, counts, percentiles):
+    """Values (bin centers, 1 HU bins) at the given percentiles of a histogram"""
+    cumulative = np.cumsum(counts)
+    ranks = np.asarray(percentiles) / 100 * (cumulative[-1] - 1)
+    return [float(start + np.searchsorted(cumulative, r, side="right")) for r in ranks]
+
+
+def dataset_fingerprint(fingerprints):
+    """Merge per-case fingerprints {case_id: case_fingerprint(...)} into the dataset statistics"""
+    cases = [fp for fp in fingerprints.values() if fp["foreground_voxels"]]
+    summary = {"n_cases": len(fingerprints), "shapes": [fp["shape"] for fp in fingerprints.values()],
+               "spacings": [fp["spacing"] for fp in fingerprints.values()],
+               "foreground_voxels": {case_id: fp["foreground_voxels"] for case_id, fp in fingerprints.items()}}
+    if not cases:
+        return summary
+    start = min(fp["histogram_start"] for fp in cases)
+    counts = np.zeros(max(fp["histogram_start"] + len(fp["histogram"]) for fp in cases) - start, dtype=np.int64)
+    for fp in cases:
+        counts[fp["histogram_start"] - start:fp["histogram_start"] - start + len(fp["histogram"])] += fp["histogram"]
+    n = sum(fp["foreground_voxels"] for fp in cases)
+    mean = sum(fp["sum"] for fp in cases) / n
+    std = np.sqrt(max(sum(fp["sum_squares"] for fp in cases) / n - mean**2, 0))
+    median, p00_5, p99_5 = histogram_percentiles(start, counts, [50, 0.5, 99.5])
+    # Same keys as nnU-Net's dataset_fingerprint.json
+    summary["foreground_intensity_properties_per_channel"] = {"0": {
+        "max": max(fp["max"] for fp in cases), "mean": mean, "median": median, "min": min(fp["min"] for fp in cases),
+        "percentile_00_5": p00_5, "percentile_99_5": p99_5, "std": float(std)}}
+    summary["median_shape"] = np.median(summary["shapes"], axis=0).tolist()
+    summary["median_spacing"] = np.median(summary["spacings"], axis=0).tolist()
+    summary["histogram"] = {"start": start, "bin_width": 1, "counts": counts.tolist()}
+    return summary
+
+
+def write_fingerprint(dataset_dir, store, split="Tr", cropped=False):
+    """Write fingerprint_stats.json of a dataset from the per-case fingerprints of its store (training cases by default).
+    For a cropped dataset (cropped=True) the cases are the crops."""
+    summary = dataset_fingerprint(store.get_fingerprints(split, crops=cropped))
+    summary["split"] = split
+    with open(os.path.join(dataset_dir, FINGERPRINT_NAME + ".tmp"), "w") as f:
+        json.dump(summary, f)
+    os.replace(os.path.join(dataset_dir, FINGERPRINT_NAME + ".tmp"), os.path.join(dataset_dir, FINGERPRINT_NAME))
+    return summary
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage instrumentation of the conversion (MUHC_nnUnet_conversion.py) and cropping (Nifti_cropping.py) scripts.
+
+Each stage of each case (patient/phase, or cropped scan) gives one record: wall time, bytes read / written, resident
+memory at its start and end and its peak memory (Linux: the kernel high-water mark is reset when a stage starts),
+and the peak memory of the process so far. Records are collected in a StageLog, which is returned by worker processes,
+and written by a RunReport to a JSON lines file, ending with a summary (percentiles per stage, slowest cases).
+
+Instrumentation is disabled by passing log=None: stage(None, ...) returns a shared no-op context.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import numpy as np
+try:
+    import resource # Peak memory on Linux / macOS
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process, in MB (None where the resource module is not available)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024) / 1e6
+    return max(peak, _peaks.process_peak) # ru_maxrss is reset with the stage peaks
+
+
+def _status_mb(field):
+    """A memory field of /proc/self/status (e.g. "VmRSS", "VmHWM"), in MB (None if not available)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024 / 1e6
+    except OSError:
+        pass
+    return None
+
+def rss_mb():
+    """Current resident memory of this process, in MB (Linux only, None elsewhere)"""
+    return _status_mb("VmRSS")
+
+
+class _PeakTracker:
+    """Peak resident memory of each running stage (Linux). The kernel high-water mark (VmHWM) is reset when a stage
+    starts (/proc/self/clear_refs); stages of other threads that are still running keep the peak seen until then,
+    and so does the process (process_peak)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {} # id(stage record) -> peak so far [MB]
+        self.process_peak = 0.0
+        self.enabled = _status_mb("VmHWM") is not None and os.access("/proc/self/clear_refs", os.W_OK)
+
+    def start(self, key):
+        if not self.enabled:
+            return
+        with self.lock:
+            hwm = _status_mb("VmHWM")
+            self.process_peak = max(self.process_peak, hwm)
+            for k in self.active:
+                self.active[k] = max(self.active[k], hwm)
+            try:
+                with open("/proc/self/clear_refs", "w") as f:
+                    f.write("5") # Reset VmHWM to the current RSS
+            except OSError:
+                self.enabled = False
+                return
+            self.active[key] = _status_mb("VmHWM")
+
+    def stop(self, key):
+        if not self.enabled:
+            return None
+        with self.lock:
+            peak = self.active.pop(key, None)
+            return None if peak is None else max(peak, _status_mb("VmHWM"))
+
+_peaks = _PeakTracker()
+
+
+def file_bytes(paths):
+    """Total size of a list of files, in bytes"""
+    return sum(os.path.getsize(p) for p in paths)
+
+
+class _Stage:
+    """Context timing one stage. The record it yields can be completed with bytes_read / bytes_written."""
+    __slots__ = ("log", "record", "start")
+
+    def __init__(self, log, record):
+        self.log = log
+        self.record = record
+
+    def __enter__(self):
+        self.record["rss_start_MB"] = rss_mb()
+        _peaks.start(id(self.record))
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, *exc):
+        self.record["seconds"] = time.perf_counter() - self.start
+        self.record["peak_rss_MB"] = _peaks.stop(id(self.record)) # This stage only (None if not available)
+        self.record["rss_end_MB"] = rss_mb()
+        self.record["process_peak_rss_MB"] = peak_rss_mb() # Since the process started
+        if exc[0] is not None:
+            self.record["error"] = repr(exc[1])
+        self.log.records.append(self.record)
+        return False
+
+
+class _NoStage:
+    """Context of a disabled stage"""
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+NO_STAGE = _NoStage()
+
+
+class StageLog:
+    """Stage records of the cases processed by one process. `case` names the records of stage() calls."""
+    def __init__(self, case=None):
+        self.case = case
+        self.records = []
+
+    def stage(self, name, **fields):
+        return _Stage(self, {"type": "stage", "case": self.case, "stage": name, **fields})
+
+
+def stage(log, name, **fields):
+    """log.stage(name, **fields), or a no-op context if the instrumentation is disabled (log is None)."""
+    return NO_STAGE if log is None else log.stage(name, **fields)
+
+
+class RunReport:
+    """JSON lines report of a run: one line per stage record (written as records come in), then a summary line."""
+    def __init__(self, path, **run_info):
+        self.path = path
+        self.records = []
+        self.start = time.time()
+        self.file = open(path, "w")
+        self._write({"type": "run", "start": time.strftime("%Y-%m-%d %H:%M:%S"), **run_info})
+
+    def _write(self, line):
+        self.file.write(json.dumps(line) + "\n")
+        self.file.flush()
+
+    def add(self, records):
+        for record in records:
+            self.records.append(record)
+            self._write(record)
+
+    def summary(self, n_slowest=10):
+        """Time percentiles and byte totals per stage, and the slowest cases (sum of their stages)"""
+        stages = {}
+        for record in self.records:
+            stages.setdefault(record["stage"], []).append(record)
+        # Peak memory of this process and of the worker processes that sent records
+        peaks = [p for p in [peak_rss_mb()] + [r.get("process_peak_rss_MB") for r in self.records] if p is not None]
+        summary = {"type": "summary", "wall_seconds": time.time() - self.start, "peak_rss_MB": max(peaks, default=None), "stages": {}}
+        for name, records in stages.items():
+            seconds = np.array([r["seconds"] for r in records])
+            p50, p90, p99 = np.percentile(seconds, [50, 90, 99])
+            summary["stages"][name] = {"count": len(records), "total_seconds": seconds.sum(), "p50": p50, "p90": p90, "p99": p99,
+                                       "max": seconds.max(), "bytes_read": sum(r.get("bytes_read", 0) for r in records),
+                                       "peak_rss_MB": max((r["peak_rss_MB"] for r in records if r.get("peak_rss_MB") is not None), default=None),
+                                       "bytes_written": sum(r.get("bytes_written", 0) for r in records)}
+        cases = {}
+        for record in self.records:
+            cases[record["case"]] = cases.get(record["case"], 0) + record["seconds"]
+        summary["slowest_cases"] = sorted(cases.items(), key=lambda c: -c[1])[:n_slowest]
+        summary["errors"] = [{"case": r["case"], "stage": r["stage"], "error": r["error"]} for r in self.records if "error" in r]
+        return summary
+
+    def close(self, n_slowest=10):
+        """Write and print the summary, and close the report file"""
+        summary = self.summary(n_slowest)
+        self._write(summary)
+        self.file.close()
+        print(f"\n> Run report: {self.path} ({summary['wall_seconds']:.1f} s, peak memory {summary['peak_rss_MB']} MB)")
+        print(f"{'stage':<16}{'count':>7}{'total s':>10}{'p50 s':>9}{'p90 s':>9}{'p99 s':>9}{'MB read':>10}{'MB written':>12}{'peak MB':>10}")
+        for name, s in summary["stages"].items():
+            peak = "-" if s["peak_rss_MB"] is None else f"{s['peak_rss_MB']:.0f}"
+            print(f"{name:<16}{s['count']:>7}{s['total_seconds']:>10.2f}{s['p50']:>9.3f}{s['p90']:>9.3f}{s['p99']:>9.3f}"
+                  f"{s['bytes_read'] / 1e6:>10.1f}{s['bytes_written'] / 1e6:>12.1f}{peak:>10}")
+        print("> Slowest cases: " + ", ".join(f"{case} ({seconds:.1f} s)" for case, seconds in summary["slowest_cases"]))
+        return summary
@@ -2,69 +2,307 @@ import nibabel as nib
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from glob import glob
 import os
+import threading
+from nifti_writer import strip_ending
 
 # --- MANUAL PATHS ---
 CT_PATH = "nnUnet_raw/Dataset801_SBRTestCROPPED/imagesTr/1207850-2_targets_CT_0_0001.nii.gz"
 LABEL_PATH = "nnUnet_raw/Dataset801_SBRTestCROPPED/labelsTr/1207850-2_targets_CT_0_0001.nii.gz"  # Leave as empty string "" if no contour
 INCLUDE_CONTOUR = bool(LABEL_PATH)
 
+# --- DATASET MODE ---
+# Set to a DatasetXXX_... folder to browse all its cases instead of CT_PATH / LABEL_PATH.
+# Keys: n / pagedown = next case, b / pageup = previous case, up / down = next / previous slice
+DATASET_DIR = ""
+prefetch_mb = 1024  # Memory for the slices of the cases decoded in advance (next and previous case)
+
 # --- OPTIONS ---
 axis = 'axial'  # Options: 'axial', 'frontal', 'transverse'
 rotate = False
+volume = 0  # Volume shown for 4D images
+cache_mb = 256  # Memory kept for decoded slices and overlays, per volume
+
+
+# --- LAZY SLICE ACCESS ---
+class LRUCache:
+    """Least recently used cache of numpy arrays, bounded by their total size in bytes"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self.items:
+            self.bytes -= self.items.pop(key).nbytes
+        self.items[key] = value
+        self.bytes += value.nbytes
+        while self.bytes > self.max_bytes and len(self.items) > 1:
+            self.bytes -= self.items.popitem(last=False)[1].nbytes
+
+
+class LazyVolume:
+    """Slices of a NIfTI volume, read on demand in the 'axial', 'frontal' or 'transverse' view.
+    .nii files are memory-mapped, so any slice is read directly from the file.
+    .nii.gz axial slices are decompressed by chunks of `chunk` slices while reading forward, from a file kept open
+    (the decompression continues). Going back in a gzip stream means decompressing it again from the start, so
+    the first read behind the current chunk, and other views, decompress the volume once in its stored dtype (load).
+    Views are strided indexes into the volume, never full-volume copies. Decoded slices are kept in an LRU cache.
+    Slices can be read from several threads (the viewer and the background decoding of the case).
+    """
+    def __init__(self, path, axis="axial", rotate=False, volume=0, cache_bytes=256 << 20, chunk=8):
+        self.path = path
+        self.img = nib.load(path, mmap=True, keep_file_open=True)
+        self.rotate = rotate
+        self.volume = volume if len(self.img.shape) == 4 else None
+        self.axis_index = {"axial": 2, "frontal": 1, "transverse": 0}[axis]
+        self.n_slices = self.img.shape[self.axis_index]
+        self.chunk = chunk
+        self.cache = LRUCache(cache_bytes)
+        self.slope, self.inter = self.img.dataobj.slope, self.img.dataobj.inter
+        self._data = None
+        self._next = 0 # First slice after the last chunk decompressed from the .nii.gz
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        if not path.endswith(".gz"):
+            self._data = self._unscaled(self.img) # memmap
+
+    def _unscaled(self, img):
+        data = img.dataobj.get_unscaled()
+        return data if self.volume is None else data[..., self.volume]
+
+    def load(self):
+        """Decompress the whole volume once, in its stored dtype (nothing to do for a memory-mapped .nii).
+        The file is opened again, so that the chunk reads of the file kept open are not affected. A thread calling
+        load while another one decompresses the volume waits for it."""
+        with self.load_lock:
+            if self._data is None:
+                self._data = self._unscaled(nib.load(self.path))
+
+    def _index(self, k):
+        index = [slice(None)] * 3
+        index[self.axis_index] = k
+        return tuple(index) + (() if self.volume is None else (self.volume,))
+
+    def _read(self, k):
+        """Slice k in the volume axes, scaled, as float32"""
+        k0 = k - k % self.chunk
+        if self._data is None and self.axis_index == 2 and k0 >= self._next:
+            # Decompress the whole chunk holding slice k
+            k1 = min(k0 + self.chunk, self.n_slices)
+            block = np.asarray(self.img.dataobj[self._index(slice(k0, k1))], dtype=np.float32)
+            self._next = k1
+            for i in range(k0, k1):
+                if i != k:
+                    self.cache.put(i, self._orient(block[:, :, i - k0]))
+            return block[:, :, k - k0]
+        self.load()
+        return (self._data[self._index(k)] * self.slope + self.inter).astype(np.float32)
+
+    def _orient(self, sl):
+        """Volume axes -> displayed axes (same as the axis swaps/flips of the full volume)"""
+        if self.axis_index == 2:
+            return sl
+        if self.axis_index == 1:
+            return sl.T[::-1] if self.rotate else sl
+        return sl.T[::-1] if self.rotate else sl.T
+
+    def __len__(self):
+        return self.n_slices
+
+    def __getitem__(self, k):
+        with self.lock:
+            sl = self.cache.get(k)
+            if sl is None:
+                sl = self._orient(self._read(k))
+                self.cache.put(k, sl)
+            return sl
+
+    def value_range(self, n_samples=5):
+        """(min, max) over a few evenly spaced slices (the full volume is never read for this)"""
+        samples = [self[int(k)] for k in np.linspace(0, self.n_slices - 1, min(n_samples, self.n_slices))]
+        return min(s.min() for s in samples), max(s.max() for s in samples)
+
+
+class Overlay:
+    """RGBA overlay of the label slices (Reds colormap, alpha 0.7 on the structure), computed once per slice"""
+    def __init__(self, labels, cache_bytes=256 << 20, cmap="Reds", alpha=0.7):
+        self.labels = labels
+        self.cmap = plt.get_cmap(cmap)
+        self.alpha = alpha
+        self.cache = LRUCache(cache_bytes)
+        self.lock = threading.Lock()
+
+    def __getitem__(self, k):
+        with self.lock:
+            rgba = self.cache.get(k)
+            if rgba is None:
+                mask = np.clip(self.labels[k], 0, 1)
+                rgba = self.cmap(mask, bytes=True)
+                rgba[..., 3] = np.round(mask * self.alpha * 255).astype(np.uint8)
+                self.cache.put(k, rgba)
+            return rgba
+
+
+def dataset_cases(dataset_dir):
+    """(name, CT path, label path or "") of the cases of a dataset, over imagesTr/labelsTr and imagesTs/labelsTs.
+    Labels are matched to images by name, without the _0000 channel suffix (or with it, for cropped datasets)."""
+    cases = []
+    for split in ["Tr", "Ts"]:
+        images = sorted(glob(os.path.join(dataset_dir, "images" + split, "*.nii.gz")) + glob(os.path.join(dataset_dir, "images" + split, "*.nii")))
+        labels = {strip_ending(os.path.basename(p)): p for p in glob(os.path.join(dataset_dir, "labels" + split, "*.nii*"))}
+        for image in images:
+            name = strip_ending(os.path.basename(image))
+            label = labels.get(name[:-len("_0000")] if name.endswith("_0000") else name) or labels.get(name, "")
+            cases.append((split + "/" + name, image, label))
+    return cases
+
+
+def open_case(ct_path, label_path, cache_bytes):
+    """LazyVolume of the CT and Overlay of the label (None if no label), with their middle slice (where the viewer
+    starts) decoded. Half of cache_bytes goes to the CT slices."""
+    ct = LazyVolume(ct_path, axis, rotate, volume, cache_bytes=cache_bytes // 2)
+    overlay = Overlay(LazyVolume(label_path, axis, rotate, volume, cache_bytes=cache_bytes // 4), cache_bytes=cache_bytes // 4) if label_path else None
+    ct[len(ct) // 2]
+    if overlay is not None:
+        overlay[len(ct) // 2]
+    return ct, overlay
+
+
+def warm_case(ct, overlay, proceed):
+    """Decode slices of an open case from the middle outwards until the caches are full. proceed() is called before
+    each step: it can wait, and stops the decoding by returning False.
+    A .nii.gz is decompressed once first (LazyVolume.load): slices around the middle are read in both directions."""
+    for volume in [ct] + ([overlay.labels] if overlay is not None else []):
+        if not proceed():
+            return
+        volume.load()
+    middle = len(ct) // 2
+    n_fit = ct.cache.max_bytes // ct[middle].nbytes
+    for k in sorted(range(len(ct)), key=lambda k: abs(k - middle))[:n_fit]:
+        if not proceed():
+            return
+        ct[k]
+        if overlay is not None:
+            overlay[k]
+
+
+class CaseBrowser:
+    """Cases of the viewer. A case is shown as soon as it is open (open_case), its slices are then decoded in the
+    background (warm_case). The next and previous cases are opened and decoded in advance, within prefetch_bytes.
+    Each case has its own thread, but one case is decoded at a time: the current case, then the next one, then the
+    previous one, so that the current case never waits for (or shares the CPU with) a neighbour."""
+    def __init__(self, cases, cache_bytes, prefetch_bytes):
+        self.cases = cases
+        self.cache_bytes = cache_bytes
+        self.prefetch_bytes = prefetch_bytes
+        self.pool = ThreadPoolExecutor(max_workers=4) # Current case, neighbours, a dropped case finishing
+        self.loaded = {} # case index -> (future of (ct, overlay), event stopping its decoding, event set once it is decoded)
+        self.after = {} # case index -> decoded event of the case decoded before it
+        self.index = 0
+
+    def open(self, i):
+        """(ct, overlay) of case i once it is open, then prefetch its neighbours"""
+        self.index = i % len(self.cases)
+        if self.index not in self.loaded:
+            self.loaded[self.index] = self.load(self.index, self.cache_bytes)
+        self.prefetch()
+        return self.loaded[self.index][0].result()
+
+    def load(self, i, cache_bytes):
+        """Open case i in a pool thread, which then decodes its slices, in turn.
+        Returns (future of (ct, overlay), stop event, decoded event); the future is done once the case is open."""
+        _, ct_path, label_path = self.cases[i]
+        opened, stop, warmed = Future(), threading.Event(), threading.Event()
+        def turn():
+            """Wait until case i is the current case or the case before it is decoded. False once the case is dropped."""
+            while not stop.is_set() and i != self.index:
+                before = self.after.get(i)
+                if before is not None and before.wait(0.05):
+                    break
+                if before is None:
+                    stop.wait(0.05)
+            return not stop.is_set()
+        def run():
+            try:
+                if not turn() or not opened.set_running_or_notify_cancel():
+                    return
+                try:
+                    case = open_case(ct_path, label_path, cache_bytes)
+                except Exception as e:
+                    opened.set_exception(e)
+                    return
+                opened.set_result(case)
+                warm_case(*case, turn)
+            finally:
+                warmed.set()
+        self.pool.submit(run)
+        return opened, stop, warmed
+
+    def prefetch(self):
+        order = list(dict.fromkeys([self.index, (self.index + 1) % len(self.cases), (self.index - 1) % len(self.cases)]))
+        # Cases out of reach are dropped (or not decoded at all), to stay within the memory budget
+        for i in list(self.loaded):
+            if i not in order:
+                opened, stop, _ = self.loaded.pop(i)
+                stop.set()
+                opened.cancel()
+        # Decoding order: current case, next one, previous one
+        for i in order[1:]:
+            if i not in self.loaded:
+                self.loaded[i] = self.load(i, self.prefetch_bytes // 2)
+        self.after = {i: self.loaded[before][2] for before, i in zip(order, order[1:])}
+
+    def close(self):
+        """Stop the background decoding (the viewer exits without waiting for it)"""
+        for _, stop, _ in self.loaded.values():
+            stop.set()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
 
 # --- LOAD DATA ---
-nii_img = nib.load(CT_PATH)
-nii_data = nii_img.get_fdata()
-
-if INCLUDE_CONTOUR:
-    c_img = nib.load(LABEL_PATH)
-    c_data = c_img.get_fdata()
-
-# --- SWAP AXES ---
-if axis == "frontal":
-    nii_data = np.swapaxes(nii_data, 1, 2)
-    if rotate:
-        nii_data = np.flip(np.swapaxes(nii_data, 0, 1), 0)
-    if INCLUDE_CONTOUR:
-        c_data = np.swapaxes(c_data, 1, 2)
-        if rotate:
-            c_data = np.flip(np.swapaxes(c_data, 0, 1), 0)
-elif axis == "transverse":
-    nii_data = np.swapaxes(nii_data, 0, 2)
-    if rotate:
-        nii_data = np.flip(nii_data, 0)
-    if INCLUDE_CONTOUR:
-        c_data = np.swapaxes(c_data, 0, 2)
-        if rotate:
-            c_data = np.flip(c_data, 0)
+if DATASET_DIR:
+    cases = dataset_cases(DATASET_DIR)
+    if not cases:
+        raise SystemExit(f"No images found in {DATASET_DIR}")
+else:
+    cases = [(os.path.basename(CT_PATH), CT_PATH, LABEL_PATH if INCLUDE_CONTOUR else "")]
+browser = CaseBrowser(cases, cache_mb << 20, prefetch_mb << 20)
+nii_data, c_data = browser.open(0)
 
 # --- PLOTTING ---
 fig, ax = plt.subplots(constrained_layout=True)
 axcolor = 'lightgoldenrodyellow'
 axpos = plt.axes([0.2, 0.1, 0.65, 0.03], facecolor=axcolor)
-nslices = nii_data.shape[2]
+nslices = len(nii_data)
 spos = Slider(axpos, 'Slice', 0, nslices - 1, valinit=nslices // 2, valstep=1)
 
 axposmin = plt.axes([0.04, 0.1, 0.03, 0.65])
 axposmax = plt.axes([0.95, 0.1, 0.03, 0.65])
-minval = min(nii_data.min(), 0)
-maxval = nii_data.max()
+minval, maxval = nii_data.value_range()
+minval = min(minval, 0)
 sposmin = Slider(axposmin, "Min", minval, maxval, valinit=minval, orientation='vertical')
 sposmax = Slider(axposmax, "Max", minval, maxval, valinit=255, orientation='vertical')
 
-img = ax.imshow(nii_data[:, :, spos.val], cmap='gray', interpolation=None, vmin=minval, vmax=255)
-if INCLUDE_CONTOUR:
-    c_img = ax.imshow(c_data[:, :, spos.val], cmap='Reds', interpolation=None, vmin=0, vmax=1, alpha=c_data[:, :, spos.val] * 0.7)
+img = ax.imshow(nii_data[int(spos.val)], cmap='gray', interpolation=None, vmin=minval, vmax=255)
+c_img = ax.imshow(c_data[int(spos.val)] if c_data is not None else np.zeros(nii_data[0].shape + (4,), np.uint8), interpolation=None)
 ax.axis('off')
 
 def updateslice(val):
     slice = int(spos.val)
-    img.set_data(nii_data[:, :, slice])
-    if INCLUDE_CONTOUR:
-        c_img.set_data(c_data[:, :, slice])
-        c_img.set_alpha(c_data[:, :, slice] * 0.7)
-    ax.set_title(f"Slice {slice}")
+    img.set_data(nii_data[slice])
+    if c_data is not None:
+        c_img.set_data(c_data[slice])
+    ax.set_title(f"{browser.cases[browser.index][0]} ({browser.index + 1}/{len(browser.cases)}) - Slice {slice}")
     fig.canvas.draw_idle()
 
 spos.on_changed(updateslice)
@@ -80,4 +318,39 @@ def updatehist(val):
 sposmin.on_changed(updatehist)
 sposmax.on_changed(updatehist)
 
-plt.show()
\ No newline at end of file
+def showcase(i):
+    """Switch the figure to case i (slice slider, window range and image extents follow the new case)"""
+    global nii_data, c_data
+    nii_data, c_data = browser.open(i)
+    n = len(nii_data)
+    spos.valmax = n - 1
+    spos.ax.set_xlim(0, n - 1)
+    newmin, newmax = nii_data.value_range()
+    newmin = min(newmin, 0)
+    for slider in (sposmin, sposmax):
+        slider.valmin, slider.valmax = newmin, newmax
+        slider.ax.set_ylim(newmin, newmax)
+    h, w = nii_data[0].shape
+    for image in (img, c_img):
+        image.set_extent((-0.5, w - 0.5, h - 0.5, -0.5))
+    if c_data is None:
+        c_img.set_data(np.zeros((h, w, 4), np.uint8))
+    ax.set_xlim(-0.5, w - 0.5)
+    ax.set_ylim(h - 0.5, -0.5)
+    spos.set_val(n // 2) # Redraws through updateslice
+
+def onkey(event):
+    if event.key in ("n", "pagedown"):
+        showcase(browser.index + 1)
+    elif event.key in ("b", "pageup"):
+        showcase(browser.index - 1)
+    elif event.key == "up":
+        spos.set_val(min(spos.val + 1, spos.valmax))
+    elif event.key == "down":
+        spos.set_val(max(spos.val - 1, 0))
+
+fig.canvas.mpl_connect('key_press_event', onkey)
+updateslice(spos.val)
+
+plt.show()
+browser.close()
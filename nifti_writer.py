@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Shared NIfTI writer for the conversion (MUHC_nnUnet_conversion.py) and cropping (Nifti_cropping.py) scripts.
+
+Output modes:
+ - "nii"   : uncompressed .nii, fastest, for scratch datasets
+ - "gzip"  : standard single-threaded gzip .nii.gz, with a configurable level
+ - "pgzip" : multi-threaded gzip. Blocks are deflated in parallel and joined into one standard gzip stream,
+             so the result is a regular .nii.gz for nibabel, SimpleITK and nnU-Net
+
+Every volume is written to a temporary file next to its target and renamed once complete, so an interrupted
+run never leaves a truncated volume behind.
+"""
+
+import gzip
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+
+OUTPUT_MODES = ("nii", "gzip", "pgzip")
+
+
+def file_ending(mode):
+    """File ending of the volumes written in a given output mode (also used for dataset.json)"""
+    if mode not in OUTPUT_MODES:
+        raise ValueError(f"Unknown NIfTI output mode '{mode}', expected one of {OUTPUT_MODES}")
+    return ".nii" if mode == "nii" else ".nii.gz"
+
+
+def strip_ending(path):
+    """Remove the .nii / .nii.gz ending of a path"""
+    for ending in (".nii.gz", ".nii"):
+        if path.endswith(ending):
+            return path[:-len(ending)]
+    return path
+
+
+class ParallelGzipFile:
+    """Write-only file object producing a single standard gzip member.
+    Data is cut in blocks that a thread pool deflates independently (zlib releases the GIL). Every block but
+    the last ends with a full flush, so the concatenated blocks form one valid deflate stream.
+    """
+    def __init__(self, fileobj, level=1, threads=None, block_size=1 << 20):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(self.threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._crc = 0
+        self._size = 0
+        # gzip header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        self.fileobj.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+
+    def _deflate(self, block, last):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+
+    def _submit(self, block, last=False):
+        self._pending.append(self._pool.submit(self._deflate, block, last))
+        # Bounded number of blocks in flight
+        while len(self._pending) > 2 * self.threads:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def read(self, *args):
+        raise io.UnsupportedOperation("ParallelGzipFile is write-only")
+
+    def tell(self):
+        return self._size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET or offset != self._size:
+            raise io.UnsupportedOperation("ParallelGzipFile can only seek to its current position")
+        return self._size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._pool is None:
+            return
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer = bytearray()
+        while self._pending:
+            self.fileobj.write(self._pending.popleft().result())
+        self.fileobj.write(struct.pack("<II", self._crc & 0xffffffff, self._size & 0xffffffff))
+        self._pool.shutdown()
+        self._pool = None
+
+
+def save_nifti(img, path, mode="gzip", level=1, threads=None):
+    """Atomically write a NIfTI image in the given output mode (see OUTPUT_MODES).
+    `level` is the gzip compression level (nibabel's default is 1), `threads` the number of compression
+    threads in "pgzip" mode (default: all cores).
+    """
+    if not path.endswith(file_ending(mode)):
+        raise ValueError(f"{path} does not end with {file_ending(mode)} (output mode '{mode}')")
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as raw:
+            if mode == "nii":
+                f = raw
+            elif mode == "gzip":
+                f = gzip.GzipFile(filename="", mode="wb", compresslevel=level, fileobj=raw, mtime=0)
+            else:
+                f = ParallelGzipFile(raw, level=level, threads=threads)
+            img.to_file_map({"image": nib.FileHolder(fileobj=f)})
+            if f is not raw:
+                f.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
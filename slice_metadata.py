@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Dataset-level slice metadata store (one SQLite file per dataset, slice_metadata.sqlite).
+
+For each converted case (<PatID>_<phase>) the store keeps what used to be pickled in sliceLOCTr/sliceLOCTs:
+the slice locations of the whole DICOM series (dcm_slice_ALL), of the slices kept in the volume (dcm_SliceLoc),
+ImagePositionPatient and PixelSpacing, plus the train/test split. Slice locations are stored as float64 arrays.
+Cropped datasets also record, for each crop, its source case and its bounding box in the source volume, so that
+crops can be mapped back to the slice positions of the full volume. Crops resampled to a target spacing also keep
+their original spacing, shape and affine (see Nifti_cropping.restore_crop).
+Each case (or crop) can also have its fingerprint statistics (see fingerprint.py).
+
+Writes are single short transactions, so worker processes can write to the same store during a conversion.
+Old sliceLOC pickles can be imported (import_pickle) and exported again for compatibility (export_pickles).
+"""
+
+import json
+import os
+import pickle
+import sqlite3
+import numpy as np
+
+METADATA_NAME = "slice_metadata.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    case_id TEXT PRIMARY KEY,
+    split TEXT,
+    slice_all BLOB,
+    slice_loc BLOB,
+    image_position TEXT,
+    pixel_spacing TEXT
+);
+CREATE TABLE IF NOT EXISTS crops (
+    crop_id TEXT PRIMARY KEY,
+    case_id TEXT,
+    x_start INTEGER, x_stop INTEGER,
+    y_start INTEGER, y_stop INTEGER,
+    z_start INTEGER, z_stop INTEGER
+);
+CREATE TABLE IF NOT EXISTS resampled (
+    crop_id TEXT PRIMARY KEY,
+    geometry TEXT
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    case_id TEXT PRIMARY KEY,
+    shape TEXT,
+    spacing TEXT,
+    foreground_voxels INTEGER,
+    hu_sum REAL, hu_sum_squares REAL,
+    hu_min REAL, hu_max REAL,
+    histogram_start INTEGER,
+    histogram BLOB
+);
+"""
+
+
+def _floats(values):
+    return [float(v) for v in values]
+
+
+class SliceMetadataStore:
+    """Slice metadata of a dataset, indexed by case ID (and crop ID). Use as a context manager."""
+    def __init__(self, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, METADATA_NAME)
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    # -------------------------------
+    # Cases
+    # -------------------------------
+    def put_case(self, case_id, split, dcm_slice_ALL, dcm_SliceLoc, ImagePositionPatient, PixelSpacing):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO cases VALUES (?, ?, ?, ?, ?, ?)",
+                            (case_id, split, np.asarray(dcm_slice_ALL, dtype=np.float64).tobytes(),
+                             np.asarray(dcm_SliceLoc, dtype=np.float64).tobytes(),
+                             json.dumps(_floats(ImagePositionPatient)), json.dumps(_floats(PixelSpacing))))
+
+    def get_case(self, case_id):
+        """Metadata of one case: {"split", "slice_all", "slice_loc", "image_position", "pixel_spacing"} (None if unknown)"""
+        row = self.db.execute("SELECT split, slice_all, slice_loc, image_position, pixel_spacing FROM cases WHERE case_id = ?",
+                              (case_id,)).fetchone()
+        if row is None:
+            return None
+        return {"split": row[0], "slice_all": np.frombuffer(row[1], dtype=np.float64), "slice_loc": np.frombuffer(row[2], dtype=np.float64),
+                "image_position": json.loads(row[3]), "pixel_spacing": json.loads(row[4])}
+
+    def cases(self, split=None):
+        """Case IDs of the store (of one split if given)"""
+        if split is None:
+            return [r[0] for r in self.db.execute("SELECT case_id FROM cases ORDER BY case_id")]
+        return [r[0] for r in self.db.execute("SELECT case_id FROM cases WHERE split = ? ORDER BY case_id", (split,))]
+
+    def __contains__(self, case_id):
+        return self.db.execute("SELECT 1 FROM cases WHERE case_id = ?", (case_id,)).fetchone() is not None
+
+    # -------------------------------
+    # Crops
+    # -------------------------------
+    def put_crops(self, case_id, crops, resampled=None):
+        """Replace the crops of case_id by crops = {crop_id: bounding box (3 slices, in x, y, z order) in its volume}.
+        resampled = {crop_id: {"spacing", "shape", "original_spacing", "original_shape", "original_affine"}} for resampled crops."""
+        with self.db:
+            self.db.execute("DELETE FROM fingerprints WHERE case_id IN (SELECT crop_id FROM crops WHERE case_id = ?)", (case_id,))
+            self.db.execute("DELETE FROM resampled WHERE crop_id IN (SELECT crop_id FROM crops WHERE case_id = ?)", (case_id,))
+            self.db.execute("DELETE FROM crops WHERE case_id = ?", (case_id,))
+            self.db.executemany("INSERT OR REPLACE INTO crops VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(crop_id, case_id, *(v for s in bbox for v in (int(s.start), int(s.stop)))) for crop_id, bbox in crops.items()])
+            self.db.executemany("INSERT OR REPLACE INTO resampled VALUES (?, ?)",
+                                [(crop_id, json.dumps(geometry)) for crop_id, geometry in (resampled or {}).items()])
+
+    def get_crop(self, crop_id):
+        """Source case, bounding box and z offset of a crop, with the slice locations of its slices and, if it was
+        resampled, its "resampled" geometry (None if unknown)"""
+        row = self.db.execute("SELECT * FROM crops WHERE crop_id = ?", (crop_id,)).fetchone()
+        if row is None:
+            return None
+        bbox = tuple(slice(row[i], row[i + 1]) for i in (2, 4, 6))
+        crop = {"case_id": row[1], "bbox": bbox, "z_offset": bbox[2].start}
+        case = self.get_case(row[1])
+        if case is not None:
+            crop["slice_loc"] = case["slice_loc"][bbox[2]]
+        resampled = self.db.execute("SELECT geometry FROM resampled WHERE crop_id = ?", (crop_id,)).fetchone()
+        if resampled is not None:
+            crop["resampled"] = json.loads(resampled[0])
+        return crop
+
+    def crops(self, case_id=None):
+        """Crop IDs of the store (of one source case if given)"""
+        if case_id is None:
+            return [r[0] for r in self.db.execute("SELECT crop_id FROM crops ORDER BY crop_id")]
+        return [r[0] for r in self.db.execute("SELECT crop_id FROM crops WHERE case_id = ? ORDER BY crop_id", (case_id,))]
+
+    # -------------------------------
+    # Fingerprint statistics
+    # -------------------------------
+    def put_fingerprint(self, case_id, fingerprint):
+        """Store the statistics of a case or crop (fingerprint.case_fingerprint)"""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (case_id, json.dumps(fingerprint["shape"]), json.dumps(fingerprint["spacing"]), fingerprint["foreground_voxels"],
+                             fingerprint["sum"], fingerprint["sum_squares"], fingerprint["min"], fingerprint["max"],
+                             fingerprint["histogram_start"], np.asarray(fingerprint["histogram"], dtype=np.int64).tobytes()))
+
+    def has_fingerprint(self, case_id):
+        return self.db.execute("SELECT 1 FROM fingerprints WHERE case_id = ?", (case_id,)).fetchone() is not None
+
+    def get_fingerprints(self, split=None, crops=False):
+        """{case_id: statistics} of the cases of the store, or of its crops if crops is True (of one split if given,
+        crops take the split of their source case)"""
+        rows = self.db.execute("""SELECT f.*, s.split, c.crop_id FROM fingerprints f LEFT JOIN crops c ON c.crop_id = f.case_id
+                                  LEFT JOIN cases s ON s.case_id = COALESCE(c.case_id, f.case_id) ORDER BY f.case_id""")
+        return {r[0]: {"shape": json.loads(r[1]), "spacing": json.loads(r[2]), "foreground_voxels": r[3], "sum": r[4], "sum_squares": r[5],
+                       "min": r[6], "max": r[7], "histogram_start": r[8], "histogram": np.frombuffer(r[9], dtype=np.int64)}
+                for r in rows if (split is None or r[10] == split) and (r[11] is not None) == crops}
+
+    # -------------------------------
+    # sliceLOC pickles
+    # -------------------------------
+    def import_pickle(self, case_id, split, pickle_path):
+        """Add a case from its sliceLOC pickle (datasets converted before the store existed)"""
+        with open(pickle_path, "rb") as f:
+            self.put_case(case_id, split, *pickle.load(f))
+
+    def export_pickles(self, dataset_dir):
+        """Write the sliceLOC{split}/<case>_LOC.pkl files of every case, as written before the store existed"""
+        for case_id in self.cases():
+            case = self.get_case(case_id)
+            folder = os.path.join(dataset_dir, "sliceLOC" + case["split"])
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, case_id + "_LOC.pkl"), "wb") as f:
+                pickle.dump([case["slice_all"].tolist(), case["slice_loc"].tolist(), case["image_position"], case["pixel_spacing"]], f)
+
+
+def load_case(dataset_dir, case_id):
+    """Metadata of one case of a dataset (see SliceMetadataStore.get_case)"""
+    with SliceMetadataStore(dataset_dir) as store:
+        return store.get_case(case_id)